@@ -1,6 +1,28 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_migrate
+
+
+def reinstall_search_index(sender, using, **kwargs):
+    # SQLite table rebuilds in later migrations drop the FTS triggers, put them back (no-op when they are there)
+    from django.db import connections
+    from .search import install
+    install(connections[using])
+
+
+def clear_genre_registry(sender, **kwargs):
+    # migrate/flush (also between TransactionTestCases) rewrite the genre rows without the model signals
+    from .genres import GENRES
+    GENRES.clear()
 
 
 class BooksysConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'booksys'
+
+    def ready(self):
+        from . import signals # connects the receivers that keep the denormalized counters up to date
+        post_migrate.connect(reinstall_search_index, sender=self)
+        post_migrate.connect(clear_genre_registry, sender=self)
+        from .db import configure_sqlite
+        connection_created.connect(configure_sqlite, dispatch_uid='booksys_configure_sqlite') # busy timeout, WAL when enabled, ... (db.py)
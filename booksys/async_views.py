@@ -0,0 +1,185 @@
+from abc import ABC, abstractmethod
+from asgiref.sync import sync_to_async
+from django.http import Http404, JsonResponse
+from django.shortcuts import get_object_or_404
+from django.views import View
+from rest_framework.exceptions import APIException
+from rest_framework.request import Request
+from rest_framework.utils.encoders import JSONEncoder
+from .models import *
+from .serializers import *
+from .queries import *
+from .cache import AsyncCachedResponseMixin
+from .pagination import KeysetPagination
+from .representations import AuthorValues, BookValues, CopyValues, is_enabled as values_path_enabled
+from .sparse import SparseFields
+from . import views
+
+"""
+Async variants of the read (GET) endpoints, for running under ASGI (librarySystem/asgi.py).
+The DRF views are synchronous, so under ASGI every request holds a thread of the sync_to_async pool for its whole duration,
+including the middleware, the response cache lookup and answering a 304, which need no database.
+These views do that part on the event loop and hand only the read itself to one sync_to_async call: the queries, building the
+rows (on the values() path like the sync views, see representations.py) or serializing, and encoding the JSON. Serializing a
+list on the loop would stop every other request for as long as it takes, and each ORM call made from the loop (aget/aiterator)
+would be a hop of its own through the same thread, more hops than the sync view needs for the same queries.
+They return the same JSON as the DRF views: same querysets, filters, sparse fields and keyset pagination.
+Search (?q=) and streamed exports (?stream=) are handed to the sync views.
+"""
+
+
+def _json(data, status=200):
+    # the same bytes as DRF's JSONRenderer
+    return JsonResponse(data, status=status, safe=False, encoder=JSONEncoder, json_dumps_params={'ensure_ascii': False, 'separators': (',', ':')})
+
+
+class AsyncReadView(AsyncCachedResponseMixin, View):
+    sync_view = None # the DRF view with the same behavior, for the cases these do not handle
+    delegated_params = ('q', 'stream')
+
+    async def dispatch(self, request, *args, **kwargs):
+        if request.method in ('GET', 'HEAD') and any(param in request.GET for param in self.delegated_params):
+            return await sync_to_async(self.sync_view.as_view())(request, *args, **kwargs)
+        try:
+            return await super().dispatch(request, Request(request), *args, **kwargs)
+        except APIException as error: # what DRF's exception handler would answer
+            detail = error.detail if isinstance(error.detail, (list, dict)) else {'detail': error.detail}
+            return _json(detail, status=error.status_code)
+        except Http404 as error:
+            return _json({'detail': str(error) or "Not found."}, status=404)
+
+
+class AsyncListView(AsyncReadView, ABC):
+    serializer_class = None
+    representation_class = None # the values() representation of the sync view's list
+    ordering_fields = []
+    list_ordering_fields = [] # the sync view's extra ?ordering= fields of the unpaginated list
+
+    @abstractmethod
+    def get_queryset(self, sparse):
+        """The queryset the serializer reads (queries.py)"""
+
+    @abstractmethod
+    def filter_queryset(self, queryset, params):
+        """The list's filters (queries.py)"""
+
+    def serialize(self, objects, sparse):
+        return self.serializer_class(objects, many=True, context={'sparse_fields': sparse}).data
+
+    def list_response(self, request, sparse, paginator):
+        """The sync view's answer (values() path or serializer), paginated or not"""
+        params = request.query_params
+        if values_path_enabled(self.sync_view):
+            representation = self.representation_class(sparse)
+            rows = representation.values(self.filter_queryset(self.serializer_class.Meta.model.objects.all(), params))
+            build = representation.data
+        else:
+            rows = self.filter_queryset(self.get_queryset(sparse), params)
+            build = lambda objects: self.serialize(objects, sparse)
+        if paginator.is_requested(request):
+            results = build(paginator.paginate_queryset(rows, request))
+            return _json({'next': paginator.get_next_link(), 'results': results})
+        ordering = paginator.requested_ordering(request) # the same allowlist as the pages
+        return _json(build(rows.order_by(ordering) if ordering else rows))
+
+    async def get(self, http_request, request):
+        sparse = SparseFields.from_request(request, self.serializer_class)
+        paginator = KeysetPagination(ordering_fields=self.ordering_fields, list_ordering_fields=self.list_ordering_fields)
+        return await sync_to_async(self.list_response)(request, sparse, paginator)
+
+
+class AsyncDetailView(AsyncReadView, ABC):
+    serializer_class = None
+
+    @abstractmethod
+    def get_queryset(self, sparse):
+        """The queryset the serializer reads (queries.py)"""
+
+    def detail_response(self, sparse, pk):
+        obj = get_object_or_404(self.get_queryset(sparse), pk=pk)
+        return _json(self.serializer_class(obj, context={'sparse_fields': sparse}).data)
+
+    async def get(self, http_request, request, pk):
+        sparse = SparseFields.from_request(request, self.serializer_class)
+        return await sync_to_async(self.detail_response)(sparse, pk)
+
+
+class AsyncGenreListView(AsyncReadView):
+    cache_models = views.GenreListView.cache_models
+    sync_view = views.GenreListView
+
+    def list_response(self, sparse):
+        return _json(GenreSerializer(Genre.objects.all(), many=True, context={'sparse_fields': sparse}).data)
+
+    async def get(self, http_request, request):
+        return await sync_to_async(self.list_response)(SparseFields.from_request(request, GenreSerializer))
+
+
+class AsyncAuthorListView(AsyncListView):
+    cache_models = views.AuthorListView.cache_models
+    sync_view = views.AuthorListView
+    serializer_class = AuthorSerializer
+    representation_class = AuthorValues
+    ordering_fields = ['name']
+    list_ordering_fields = AUTHOR_LIST_ORDERING_FIELDS
+
+    def get_queryset(self, sparse):
+        return author_queryset(sparse)
+
+    def filter_queryset(self, queryset, params):
+        return filter_authors(queryset, params)
+
+
+class AsyncAuthorDetailView(AsyncDetailView):
+    cache_models = views.AuthorDetailView.cache_models
+    sync_view = views.AuthorDetailView
+    serializer_class = AuthorSerializer
+
+    def get_queryset(self, sparse):
+        return author_queryset(sparse)
+
+
+class AsyncBookListView(AsyncListView):
+    cache_models = views.BookListView.cache_models
+    sync_view = views.BookListView
+    serializer_class = BookSerializer
+    representation_class = BookValues
+    ordering_fields = BOOK_ORDERING_FIELDS
+
+    def get_queryset(self, sparse):
+        return book_queryset(sparse)
+
+    def filter_queryset(self, queryset, params):
+        return filter_books(queryset, params)
+
+
+class AsyncBookDetailView(AsyncDetailView):
+    cache_models = views.BookDetailView.cache_models
+    sync_view = views.BookDetailView
+    serializer_class = BookSerializer
+
+    def get_queryset(self, sparse):
+        return book_queryset(sparse)
+
+
+class AsyncCopyListView(AsyncListView):
+    cache_models = views.CopyListView.cache_models
+    sync_view = views.CopyListView
+    serializer_class = CopySerializer
+    representation_class = CopyValues
+    ordering_fields = ['lent']
+
+    def get_queryset(self, sparse):
+        return copy_queryset(sparse)
+
+    def filter_queryset(self, queryset, params):
+        return filter_copies(queryset, params)
+
+
+class AsyncCopyDetailView(AsyncDetailView):
+    cache_models = views.CopyDetailView.cache_models
+    sync_view = views.CopyDetailView
+    serializer_class = CopySerializer
+
+    def get_queryset(self, sparse):
+        return copy_queryset(sparse)
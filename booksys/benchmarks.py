@@ -0,0 +1,203 @@
+import json
+import statistics
+import time
+import tracemalloc
+from datetime import date, timedelta
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from .models import *
+from .instrumentation import is_enabled as instrumentation_enabled
+from .renderers import available_renderers
+
+"""
+The requests the benchmark runner (management command run_benchmarks) sends, one or more per url in booksys/urls.py.
+Every case is timed `repeat` times with nothing else going on, then run once more with query capturing and tracemalloc on
+for the query count and the peak memory (those two slow the request down, so they are not part of the timings).
+Writes (POST/DELETE) run inside a transaction that is rolled back, so every repeat sees the same catalog.
+"""
+
+PAGE = {'page_size': 50}
+
+
+def _loan():
+    return {'lent_by': "Benchmark", 'return_date': (date.today() + timedelta(days=14)).isoformat()}
+
+
+def _copy_ids(lent, count=100):
+    return list(Copy.objects.filter(lent=lent).order_by('pk').values_list('pk', flat=True)[:count])
+
+
+# url name -> [(case name, method, query params or body)], tests check that every url in urls.py is here
+CASES = {
+    'genre-list': [('all', 'GET', {})],
+    'author-list': [
+        ('all', 'GET', {}),
+        ('page', 'GET', PAGE),
+        ('search', 'GET', {'q': 'river'}),
+        ('role', 'GET', {'role': 'writer', **PAGE}),
+    ],
+    'author-detail': [('one', 'GET', {})],
+    'book-list': [
+        ('all', 'GET', {}),
+        ('page', 'GET', PAGE),
+        ('page by rating', 'GET', {'ordering': '-rating', **PAGE}),
+        ('genre', 'GET', {'genres': 'fantasy', **PAGE}),
+        ('all genres', 'GET', {'genres__all': 'fantasy,horror', **PAGE}),
+        ('rating range', 'GET', {'rating__gte': 4, 'date_published__gte': '2000-01-01', 'ordering': '-rating', **PAGE}),
+        ('search', 'GET', {'q': 'river shadow'}),
+        ('sparse', 'GET', {'fields': 'id,title', **PAGE}),
+        ('stream', 'GET', {'stream': 'ndjson'}),
+        ('msgpack', 'GET', {'format': 'msgpack'}), # against 'all' (JSON)
+        ('arrow', 'GET', {'format': 'arrow'}),
+    ],
+    'book-bulk': [('upsert', 'POST', lambda: [
+        {'title': "Benchmark book", 'blurb': "blurb", 'rating': 4.0, 'date_published': '2020-01-01', 'genres': ['fantasy'],
+         'authors': [{'author': "Author 0", 'role': "writer"}]},
+    ])],
+    'book-detail': [('one', 'GET', {})],
+    'book-checkout': [('any copy', 'POST', _loan)],
+    'copy-list': [
+        ('all', 'GET', {}),
+        ('page', 'GET', PAGE),
+        ('lent', 'GET', {'lent': 'true', **PAGE}),
+        ('msgpack', 'GET', {'format': 'msgpack'}),
+        ('arrow', 'GET', {'format': 'arrow'}),
+    ],
+    'copy-bulk': [('create 100', 'POST', {'book': 'Book 0', 'count': 100}), ('retire', 'DELETE', {'book': 'Book 0'})],
+    # + 1 query for picking the ids
+    'copy-batch-checkout': [('100', 'POST', lambda: {'ids': _copy_ids(lent=False), **_loan()})],
+    'copy-batch-return': [('100', 'POST', lambda: {'ids': _copy_ids(lent=True)})],
+    'copy-lent': [('page', 'GET', PAGE), ('by borrower', 'GET', {'group_by': 'lent_by'})],
+    'copy-overdue': [('page', 'GET', PAGE), ('by borrower', 'GET', {'group_by': 'lent_by'})],
+    'copy-due': [('page', 'GET', {'within': '7d', **PAGE}), ('by book', 'GET', {'within': '7d', 'group_by': 'book'})],
+    'copy-detail': [('one', 'GET', {})],
+    'copy-checkout': [('one', 'POST', _loan)],
+    'copy-return': [('one', 'POST', {})],
+    'stats': [('all', 'GET', {})],
+    'change-list': [('cursor', 'GET', {}), ('since 0', 'GET', {'since': 0})],
+    'metrics': [('all', 'GET', {})],
+}
+# the async GET endpoints (async_views.py) with the same requests, minus the ones they hand to the sync views and the
+# columnar formats (JSON only)
+ASYNC_NAMES = ['genre-list', 'author-list', 'author-detail', 'book-list', 'book-detail', 'copy-list', 'copy-detail']
+for _name in ASYNC_NAMES:
+    CASES[f'async-{_name}'] = [case for case in CASES[_name] if not {'q', 'stream', 'format'} & set(case[2])]
+
+
+def url_args():
+    """The pk each detail/action url is called with: rows the request can actually succeed on"""
+    book = Book.objects.filter(num_available__gt=0).order_by('pk').values_list('pk', flat=True).first()
+    args = {
+        'author-detail': Author.objects.order_by('pk').values_list('pk', flat=True).first(),
+        'book-detail': book,
+        'book-checkout': book,
+        'copy-detail': Copy.objects.order_by('pk').values_list('pk', flat=True).first(),
+        'copy-checkout': Copy.objects.filter(lent=False).order_by('pk').values_list('pk', flat=True).first(),
+        'copy-return': Copy.objects.filter(lent=True).order_by('pk').values_list('pk', flat=True).first(),
+    }
+    args.update({f'async-{name}': args[name] for name in ASYNC_NAMES if name in args})
+    return args
+
+
+def _request(client, method, url, data):
+    data = data() if callable(data) else data
+    if method == 'GET':
+        response = client.get(url, data)
+        if response.streaming:
+            b''.join(response.streaming_content) # the time to produce the whole export is what matters
+        return response
+    with transaction.atomic():
+        if method == 'DELETE':
+            response = client.delete(url, query_params=data)
+        else:
+            response = client.post(url, data, content_type='application/json')
+        transaction.set_rollback(True)
+    return response
+
+
+def _summary(timings):
+    ordered = sorted(timings)
+    return {
+        'min': round(ordered[0], 3),
+        'p50': round(statistics.median(ordered), 3),
+        'p95': round(ordered[min(len(ordered) - 1, round(0.95 * len(ordered)) - 1)], 3),
+        'max': round(ordered[-1], 3),
+        'mean': round(statistics.fmean(ordered), 3),
+    }
+
+
+def run_suite(client, repeat=5, only=None):
+    """Runs every case and returns one result dict per case"""
+    args = url_args()
+    formats = {renderer.format for renderer in available_renderers()}
+    results = []
+    for name, cases in CASES.items():
+        for case, method, data in cases:
+            label = f'{name} {case}'
+            if only and only not in label:
+                continue
+            if name == 'metrics' and not instrumentation_enabled(): # a 404 without BOOKSYS_INSTRUMENTATION
+                results.append({'name': label, 'skipped': "instrumentation is off"})
+                continue
+            if isinstance(data, dict) and data.get('format', 'json') not in formats | {'json'}: # msgpack/pyarrow not installed
+                results.append({'name': label, 'skipped': f"{data['format']} is not installed"})
+                continue
+            pk = args.get(name)
+            if name in args and pk is None: # e.g. no lent copy to return in this catalog
+                results.append({'name': label, 'skipped': "no row to call it with"})
+                continue
+            url = reverse(name, args=[pk]) if name in args else reverse(name)
+
+            _request(client, method, url, data) # warm up (imports, first connection, ...)
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                response = _request(client, method, url, data)
+                timings.append((time.perf_counter() - started) * 1000)
+
+            tracemalloc.start()
+            try:
+                with CaptureQueriesContext(connection) as queries:
+                    _request(client, method, url, data)
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+
+            results.append({
+                'name': label,
+                'method': method,
+                'url': url,
+                'status': response.status_code,
+                'latency_ms': _summary(timings),
+                'queries': len(queries),
+                'peak_memory_kb': round(peak / 1024, 1),
+                'response_kb': None if response.streaming else round(len(response.content) / 1024, 1), # JSON vs msgpack/arrow
+            })
+    return results
+
+
+def compare(baseline, current):
+    """Lines with the p50 latency of every case of `current` against the same size/case in `baseline` (both run_benchmarks output)"""
+    before = {
+        (run['size'], result['name']): result
+        for run in baseline.get('runs', []) for result in run['results'] if 'latency_ms' in result
+    }
+    lines = []
+    for run in current['runs']:
+        for result in run['results']:
+            old = before.get((run['size'], result['name']))
+            if old is None or 'latency_ms' not in result:
+                continue
+            old_p50, new_p50 = old['latency_ms']['p50'], result['latency_ms']['p50']
+            ratio = new_p50 / old_p50 if old_p50 else float('inf')
+            lines.append(
+                f"{run['size']:>6} {result['name']:<28} {old_p50:>10.2f}ms -> {new_p50:>10.2f}ms ({ratio:.2f}x)"
+                f"  queries {old['queries']} -> {result['queries']}"
+            )
+    return lines
+
+
+def load(path):
+    with open(path) as file:
+        return json.load(file)
@@ -0,0 +1,396 @@
+from django.conf import settings
+from django.core.exceptions import EmptyResultSet
+from django.db import connections, transaction
+from django.db.models import Q
+from rest_framework import serializers
+from .models import *
+from .counters import refresh_author_ratings, refresh_book_counters, refresh_ratings_for_books
+from .stats import mark_book_rollups, mark_books
+from .cache import bump_versions
+from .genres import GENRES
+from .changes import record, record_books, record_deleted
+
+"""
+Set based bulk writes. Everything an import references is resolved with one IN query per model, missing rows are created with
+bulk_create and links are written in batches, so importing n books costs a handful of queries per batch instead of several per book.
+bulk_create/update and the plain DELETEs skip the model signals so the denormalized counters are refreshed (and the response cache
+versions bumped) once per call at the end, and what was written is recorded in the change feed (changes.py) here too.
+"""
+
+
+def batch_size():
+    return getattr(settings, 'BOOKSYS_BULK_BATCH_SIZE', 1000)
+
+
+def delete_without_signals(queryset):
+    """
+    A single DELETE ... WHERE pk IN (<the queryset>) statement, returns how many rows went.
+    queryset.delete() would load every row to send post_delete, callers refresh the counters themselves.
+    """
+    model, connection = queryset.model, connections[queryset.db]
+    try:
+        subquery, params = queryset.order_by().values('pk').query.sql_with_params()
+    except EmptyResultSet: # e.g. pk__in=[], matches nothing
+        return 0
+    table, pk = connection.ops.quote_name(model._meta.db_table), connection.ops.quote_name(model._meta.pk.column)
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {table} WHERE {pk} IN ({subquery})', params)
+        deleted = cursor.rowcount
+    bump_versions(model)
+    return deleted
+
+
+class BulkBookSerializer(serializers.ModelSerializer):
+    """Validates the plain fields of one item, the relations are resolved for the whole payload at once in BulkBookUpsert"""
+    genres = serializers.ListField(required=False)
+    authors = serializers.ListField(child=serializers.DictField(), required=False)
+
+    class Meta:
+        model = Book
+        fields = ['title', 'blurb', 'rating', 'date_published', 'genres', 'authors']
+        extra_kwargs = {'title': {'validators': []}} # an existing title is an update here, not an error
+
+    def validate_authors(self, value):
+        for entry in value:
+            if 'author' not in entry or not isinstance(entry.get('role'), str) or not entry['role']:
+                raise serializers.ValidationError("Each author needs an author and a role.")
+        return value
+
+
+class BulkAuthorSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Author
+        fields = ['name', 'introduction', 'place_of_origin']
+        extra_kwargs = {'name': {'validators': []}} # only called for names that are known to be missing
+
+
+class BulkGenreSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Genre
+        fields = ['name']
+        extra_kwargs = {'name': {'validators': []}}
+
+
+class References:
+    """The objects one relation of an upsert payload points to: by ID and name, and the ones to create (given as dicts)"""
+
+    def __init__(self, model, name_field, get_refs):
+        self.model = model
+        self.name_field = name_field
+        self.get_refs = get_refs
+        self.by_id, self.by_name = {}, {}
+        self.pending = {} # name -> unsaved object
+
+    def create(self, valid):
+        """Bulk creates the pending objects the remaining items refer to (by object or by name)"""
+        names = {ref[self.name_field] if isinstance(ref, dict) else ref
+                 for data in valid.values() for ref in self.get_refs(data) if isinstance(ref, (str, dict))}
+        new_objects = [obj for name, obj in self.pending.items() if name in names]
+        for obj in self.model.objects.bulk_create(new_objects, batch_size=batch_size()):
+            self.by_name[getattr(obj, self.name_field)] = obj
+        if new_objects:
+            bump_versions(self.model)
+            record(self.model, [obj.pk for obj in new_objects])
+
+    def __call__(self, ref):
+        if isinstance(ref, int):
+            return self.by_id[ref]
+        return self.by_name[ref if isinstance(ref, str) else ref[self.name_field]]
+
+
+class BulkBookUpsert:
+    """
+    Creates or updates (matched by title) a list of books with their genres and authors.
+    Genres and authors can be given the same way as in BookSerializer: an ID, a name or an object to create if it is missing.
+    Items that fail validation are reported by index and skipped, the rest are written in one transaction.
+    """
+
+    def __init__(self, items):
+        self.items = items
+        self.errors = {}
+        self.created = []
+        self.updated = []
+
+    def add_error(self, index, field, message):
+        self.errors.setdefault(index, {}).setdefault(field, []).append(message)
+
+    def run(self):
+        valid = {}
+        seen_titles = set()
+        for index, item in enumerate(self.items):
+            serializer = BulkBookSerializer(data=item)
+            if not serializer.is_valid():
+                self.errors[index] = serializer.errors
+                continue
+            title = serializer.validated_data['title']
+            if title in seen_titles:
+                self.add_error(index, 'title', "This title appears more than once in the payload.")
+                continue
+            seen_titles.add(title)
+            valid[index] = serializer.validated_data
+
+        with transaction.atomic():
+            existing = {book.title: book for book in Book.objects.filter(title__in=[data['title'] for data in valid.values()])}
+            for index, data in list(valid.items()):
+                if data['title'] not in existing and not data.get('authors'): # same rule as BookSerializer.validate
+                    self.add_error(index, 'authors', "This field is required.")
+                    valid.pop(index)
+            genres = self.resolve(valid, 'genres', Genre, 'name', BulkGenreSerializer, self.genre_refs)
+            authors = self.resolve(valid, 'authors', Author, 'name', BulkAuthorSerializer, self.author_refs)
+            # only now that every item is checked, so a rejected item never leaves a genre/author behind
+            genres.create(valid)
+            authors.create(valid)
+            self.write(valid, existing, genres, authors)
+
+        return {
+            'created': self.created,
+            'updated': self.updated,
+            'errors': [{'index': index, 'errors': errors} for index, errors in sorted(self.errors.items())],
+        }
+
+    @staticmethod
+    def genre_refs(data):
+        return data.get('genres') or []
+
+    @staticmethod
+    def author_refs(data):
+        return [entry.get('author') for entry in data.get('authors') or []]
+
+    def resolve(self, valid, field, model, name_field, create_serializer, get_refs):
+        """
+        Maps every reference in the payload to an object with one query and drops the items with a bad one.
+        Nothing is created yet, References.create() does that for the items that are still valid once every check is done.
+        """
+        ids, names, to_create = set(), set(), {}
+        for data in valid.values():
+            for ref in get_refs(data):
+                if isinstance(ref, bool): # bool is an int subclass
+                    continue
+                if isinstance(ref, int):
+                    ids.add(ref)
+                elif isinstance(ref, str):
+                    names.add(ref)
+                elif isinstance(ref, dict) and ref.get(name_field):
+                    names.add(ref[name_field])
+                    to_create.setdefault(ref[name_field], ref)
+
+        references = References(model, name_field, get_refs)
+        table = GENRES.table() if model is Genre else None
+        if table is not None: # every genre is in memory (genres.py)
+            references.by_id, references.by_name = dict(table.by_pk), dict(table.by_name)
+        elif ids or names:
+            for obj in model.objects.filter(Q(pk__in=ids) | Q(**{f'{name_field}__in': names})):
+                references.by_id[obj.pk] = obj
+                references.by_name[getattr(obj, name_field)] = obj
+
+        invalid = {}
+        for name, ref in to_create.items():
+            if name in references.by_name:
+                continue
+            serializer = create_serializer(data=ref)
+            if serializer.is_valid():
+                references.pending[name] = model(**serializer.validated_data)
+            else:
+                invalid[name] = serializer.errors
+
+        # check every item's references, an item with a bad one is skipped as a whole
+        known_names = references.by_name.keys() | references.pending.keys()
+        for index, data in list(valid.items()):
+            for ref in get_refs(data):
+                message = None
+                if isinstance(ref, bool) or not isinstance(ref, (int, str, dict)):
+                    message = f"{model.__name__} must be an ID (int), name (str) or object (dict)."
+                elif isinstance(ref, int) and ref not in references.by_id:
+                    message = f"No {model.__name__.lower()} exists with this ID"
+                elif isinstance(ref, str) and ref not in known_names:
+                    message = f"No {model.__name__.lower()} exists with this name"
+                elif isinstance(ref, dict) and not ref.get(name_field):
+                    message = f"{model.__name__} {name_field} is required when creating a {model.__name__.lower()}"
+                elif isinstance(ref, dict) and ref[name_field] in invalid:
+                    message = invalid[ref[name_field]]
+                if message:
+                    self.add_error(index, field, message)
+                    valid.pop(index)
+                    break
+        return references
+
+    def write(self, valid, existing, genres, authors):
+        new_books, changed_books, rating_moved = [], [], []
+        book_for_index = {}
+        for index, data in valid.items():
+            fields = {key: value for key, value in data.items() if key not in ('genres', 'authors')}
+            book = existing.get(data['title'])
+            if book is None:
+                book = Book(**fields)
+                new_books.append(book)
+            else:
+                if 'rating' in fields and fields['rating'] != book.rating:
+                    rating_moved.append(book.pk)
+                for attr, value in fields.items():
+                    setattr(book, attr, value)
+                changed_books.append(book)
+            book_for_index[index] = book
+
+        mark_book_rollups(book.pk for book in changed_books) # the genres/years they are in before the update
+        Book.objects.bulk_create(new_books, batch_size=batch_size())
+        Book.objects.bulk_update(changed_books, ['blurb', 'rating', 'date_published'], batch_size=batch_size())
+
+        # links of updated books are replaced only when the item gives them (like a PATCH)
+        replaced_genres = [book_for_index[index].pk for index, data in valid.items() if index in book_for_index and 'genres' in data]
+        replaced_authors = [book_for_index[index].pk for index, data in valid.items() if index in book_for_index and 'authors' in data]
+        GenreLink = Book.genres.through
+        delete_without_signals(GenreLink.objects.filter(book_id__in=replaced_genres))
+        affected_authors = set(BookAuthor.objects.filter(book__in=replaced_authors).values_list('author', flat=True))
+        delete_without_signals(BookAuthor.objects.filter(book__in=replaced_authors))
+
+        genre_links, author_links = {}, {}
+        for index, data in valid.items():
+            if index not in book_for_index:
+                continue
+            book = book_for_index[index]
+            for ref in data.get('genres') or []:
+                genre = genres(ref)
+                genre_links[(book.pk, genre.pk)] = GenreLink(book_id=book.pk, genre_id=genre.pk)
+            for entry in data.get('authors') or []:
+                author = authors(entry.get('author'))
+                author_links[(book.pk, author.pk)] = BookAuthor(book=book, author=author, role=entry['role'])
+                affected_authors.add(author.pk)
+
+        GenreLink.objects.bulk_create(genre_links.values(), batch_size=batch_size())
+        BookAuthor.objects.bulk_create(author_links.values(), batch_size=batch_size())
+        refresh_author_ratings(affected_authors)
+        refresh_ratings_for_books(rating_moved) # their (current) authors, also when the item does not give the authors
+        mark_books(book.pk for book in new_books + changed_books)
+        bump_versions(Book, BookAuthor, Author) # Genre only when References.create made some
+        record(Book, [book.pk for book in new_books])
+        record_books([book.pk for book in changed_books], copies=True, authors=True)
+
+        self.created = [book.pk for book in new_books]
+        self.updated = [book.pk for book in changed_books]
+
+
+class BulkCopySerializer(serializers.ModelSerializer):
+    """One copy spec of a bulk provisioning: the book (ID or title), how many copies and the same lending fields as CopySerializer"""
+    book = serializers.JSONField()
+    count = serializers.IntegerField(min_value=1, default=1)
+
+    class Meta:
+        model = Copy
+        fields = ['book', 'count', 'lent', 'lent_by', 'return_date']
+
+    def validate_book(self, value):
+        if isinstance(value, bool) or not isinstance(value, (int, str)):
+            raise serializers.ValidationError("Book must be an ID (int) or title (str).")
+        return value
+
+    def validate_count(self, value):
+        limit = getattr(settings, 'BOOKSYS_BULK_MAX_COPIES', 10000)
+        if value > limit:
+            raise serializers.ValidationError(f"At most {limit} copies per item.")
+        return value
+
+    def validate(self, data):
+        # CopySerializer.validate
+        if data.get('lent'):
+            if not data.get('lent_by'):
+                raise serializers.ValidationError({"lent_by": "This field is required when the book is lent."})
+            if not data.get('return_date'):
+                raise serializers.ValidationError({"return_date": "This field is required when the book is lent."})
+        return data
+
+
+class BulkCopyCreate:
+    """
+    Creates the copies of a shipment: a list of copy specs, each `count` times, with one book query for the whole payload and
+    bulk_create. Items that fail validation are reported by index and skipped, the rest are written in one transaction.
+    """
+
+    def __init__(self, items):
+        self.items = items
+        self.errors = {}
+        self.created = []
+
+    def run(self):
+        valid = {}
+        for index, item in enumerate(self.items):
+            serializer = BulkCopySerializer(data=item)
+            if serializer.is_valid():
+                valid[index] = serializer.validated_data
+            else:
+                self.errors[index] = serializer.errors
+
+        refs = [data['book'] for data in valid.values()]
+        by_id, by_title = {}, {}
+        if refs:
+            ids = [ref for ref in refs if isinstance(ref, int)]
+            titles = [ref for ref in refs if isinstance(ref, str)]
+            for book_id, title in Book.objects.filter(Q(pk__in=ids) | Q(title__in=titles)).values_list('pk', 'title'):
+                by_id[book_id] = book_id
+                by_title[title] = book_id
+
+        copies = []
+        for index, data in list(valid.items()):
+            ref = data.pop('book')
+            book_id = by_id.get(ref) if isinstance(ref, int) else by_title.get(ref)
+            if book_id is None:
+                self.errors[index] = {'book': [f"No book exists with this {'ID' if isinstance(ref, int) else 'title'}"]}
+                continue
+            count = data.pop('count')
+            copies += [Copy(book_id=book_id, **data) for _ in range(count)]
+
+        if copies:
+            with transaction.atomic():
+                Copy.objects.bulk_create(copies, batch_size=batch_size())
+                book_ids = {copy.book_id for copy in copies}
+                # once for the whole shipment, the signals would do it per copy
+                refresh_book_counters(book_ids)
+                mark_books(book_ids)
+                bump_versions(Copy)
+                record(Copy, [copy.pk for copy in copies])
+
+        self.created = [copy.pk for copy in copies]
+        return {
+            'created': self.created,
+            'errors': [{'index': index, 'errors': errors} for index, errors in sorted(self.errors.items())],
+        }
+
+
+def retire_copies(copies):
+    """Deletes the copies of a (filtered) queryset with one DELETE, returns how many were deleted"""
+    with transaction.atomic():
+        retired = list(copies.order_by().values_list('pk', 'book_id'))
+        book_ids = {book_id for _, book_id in retired}
+        deleted = delete_without_signals(Copy.objects.filter(pk__in=copies.values('pk')))
+        refresh_book_counters(book_ids)
+        mark_books(book_ids)
+        record_deleted(Copy, [pk for pk, _ in retired])
+    return deleted
+
+
+def sync_book_authors(existing, wanted, key):
+    """
+    Makes the BookAuthor rows of one book/author match `wanted` (unsaved BookAuthor objects) with one filtered delete,
+    one bulk_create and one bulk_update instead of deleting and recreating every link.
+    `key` is the side that varies between the links ('author_id' for a book's links, 'book_id' for an author's links).
+    """
+    existing = {getattr(link, key): link for link in existing}
+    wanted = {getattr(link, key): link for link in wanted} # the last entry wins if the same book/author is given twice
+
+    removed = [link for value, link in existing.items() if value not in wanted]
+    added = [link for value, link in wanted.items() if value not in existing]
+    changed = []
+    for value, link in wanted.items():
+        current = existing.get(value)
+        if current is not None and current.role != link.role:
+            current.role = link.role
+            changed.append(current)
+
+    if removed:
+        delete_without_signals(BookAuthor.objects.filter(pk__in=[link.pk for link in removed]))
+    BookAuthor.objects.bulk_create(added, batch_size=batch_size())
+    BookAuthor.objects.bulk_update(changed, ['role'], batch_size=batch_size())
+    bump_versions(BookAuthor)
+    # a role change does not move any average, only links that came or went do
+    refresh_author_ratings(link.author_id for link in removed + added)
+    record(Book, [link.book_id for link in removed + added + changed])
+    record(Author, [link.author_id for link in changed]) # the others were recorded by the refresh
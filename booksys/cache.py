@@ -0,0 +1,205 @@
+import hashlib
+import time
+from django.conf import settings
+from django.core import checks
+from django.core.cache import caches
+from django.db import transaction
+from django.http import HttpResponse, HttpResponseNotModified
+from .instrumentation import measure
+
+"""
+Response cache for the GET views.
+Every model has a version counter in the cache that is bumped on each write (signals.py for single objects, the bulk code paths
+bump explicitly). A response is stored under a hash of the path, the normalized query params, the Accept header and the versions
+of the models it depends on, and that same hash is its ETag. So checking a request's If-None-Match or finding its cached body only
+needs the version counters from the cache, never the ORM, and a write simply makes every older entry unreachable.
+Works with any Django cache backend that all the worker processes share, settings.py configures the file based one.
+"""
+
+
+def get_cache():
+    return caches[getattr(settings, 'BOOKSYS_CACHE_ALIAS', 'booksys')]
+
+
+def is_enabled():
+    return getattr(settings, 'BOOKSYS_RESPONSE_CACHE', True)
+
+
+@checks.register(checks.Tags.caches)
+def check_shared_cache(app_configs, **kwargs):
+    # the version counters of a local memory cache live in one process, the other workers would keep serving what it invalidated
+    backend = settings.CACHES.get(getattr(settings, 'BOOKSYS_CACHE_ALIAS', 'booksys'), {}).get('BACKEND', '')
+    if is_enabled() and backend.endswith('LocMemCache'):
+        return [checks.Warning(
+            "The booksys response cache uses a local memory cache, which only works with a single process.",
+            hint="Configure a cache that all the worker processes share (file based, database, redis, ...) or set BOOKSYS_RESPONSE_CACHE = False.",
+            id='booksys.W001',
+        )]
+    return []
+
+
+def version_key(model):
+    return f'booksys:version:{model._meta.label_lower}'
+
+
+def _initial_version():
+    # not 0/1 so a cache that was cleared (or a restarted locmem cache) never reuses a version that was already handed out
+    return time.time_ns()
+
+
+def _bump(models):
+    cache = get_cache()
+    for model in models:
+        key = version_key(model)
+        try:
+            cache.incr(key)
+        except ValueError: # missing (never read yet, evicted or cleared)
+            cache.set(key, _initial_version(), None)
+
+
+def bump_versions(*models):
+    """Invalidates the cached responses that depend on these models"""
+    if not models:
+        return
+    _bump(models)
+    # bump again once the transaction commits, a response cached between the first bump and the commit could hold the old data
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(lambda: _bump(models))
+
+
+def _missing_versions(keys, versions):
+    return {key: _initial_version() for key in keys if key not in versions}
+
+
+def get_versions(models):
+    cache = get_cache()
+    keys = [version_key(model) for model in models]
+    versions = cache.get_many(keys)
+    missing = _missing_versions(keys, versions)
+    if missing:
+        cache.set_many(missing, None)
+        versions.update(missing)
+    return [versions[key] for key in keys]
+
+
+async def aget_versions(models):
+    cache = get_cache()
+    keys = [version_key(model) for model in models]
+    versions = await cache.aget_many(keys)
+    missing = _missing_versions(keys, versions)
+    if missing:
+        await cache.aset_many(missing, None)
+        versions.update(missing)
+    return [versions[key] for key in keys]
+
+
+def make_etag(request, versions):
+    query = sorted((key, sorted(values)) for key, values in request.GET.lists())
+    parts = [request.path, repr(query), request.headers.get('Accept', ''), repr(versions)]
+    return '"%s"' % hashlib.sha256('|'.join(parts).encode()).hexdigest()
+
+
+def _if_none_match(request):
+    header = request.headers.get('If-None-Match')
+    return [tag.strip() for tag in header.split(',')] if header else []
+
+
+def etag_matches(request, etag):
+    tags = _if_none_match(request)
+    return etag in tags or f'W/{etag}' in tags
+
+
+def _checked(request, response, etag):
+    # If-None-Match: * matches any current representation, so only once the view found one (not for a 404)
+    if response.status_code == 200 and not response.streaming and '*' in _if_none_match(request):
+        return _not_modified(etag)
+    return response
+
+
+class CachedResponseMixin:
+    """
+    Add to an APIView and list the models its GET responses are built from in `cache_models`.
+    Answers If-None-Match with a 304 and repeats of the same request from the cache without touching the db.
+    """
+    cache_models = ()
+
+    def get_cache_vary(self, request):
+        # anything besides the request and the models the response depends on (e.g. today's date)
+        return []
+
+    def dispatch(self, request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD') or not self.cache_models or not is_enabled():
+            return super().dispatch(request, *args, **kwargs)
+
+        etag = make_etag(request, get_versions(self.cache_models) + self.get_cache_vary(request))
+        if etag_matches(request, etag):
+            return _not_modified(etag)
+
+        cache = get_cache()
+        key = _response_key(etag)
+        cached = cache.get(key)
+        if cached is not None:
+            return _checked(request, _from_cache(cached, etag), etag)
+        response = super().dispatch(request, *args, **kwargs)
+        entry = _cache_entry(response)
+        if entry is not None:
+            cache.set(key, entry, _timeout())
+        return _checked(request, _with_etag(response, etag), etag)
+
+
+class AsyncCachedResponseMixin(CachedResponseMixin):
+    """The same for views with async handlers (async_views.py), reads and writes the cache with its async API"""
+
+    async def dispatch(self, request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD') or not self.cache_models or not is_enabled():
+            return await super(CachedResponseMixin, self).dispatch(request, *args, **kwargs)
+
+        etag = make_etag(request, await aget_versions(self.cache_models) + self.get_cache_vary(request))
+        if etag_matches(request, etag):
+            return _not_modified(etag)
+
+        cache = get_cache()
+        key = _response_key(etag)
+        cached = await cache.aget(key)
+        if cached is not None:
+            return _checked(request, _from_cache(cached, etag), etag)
+        response = await super(CachedResponseMixin, self).dispatch(request, *args, **kwargs)
+        entry = _cache_entry(response)
+        if entry is not None:
+            await cache.aset(key, entry, _timeout())
+        return _checked(request, _with_etag(response, etag), etag)
+
+
+def _response_key(etag):
+    return f'booksys:response:{etag}'
+
+
+def _timeout():
+    return getattr(settings, 'BOOKSYS_CACHE_TIMEOUT', 300)
+
+
+def _not_modified(etag):
+    response = HttpResponseNotModified()
+    response['ETag'] = etag
+    return response
+
+
+def _from_cache(cached, etag):
+    content, content_type = cached
+    return _with_etag(HttpResponse(content, content_type=content_type), etag)
+
+
+def _with_etag(response, etag):
+    if response.status_code == 200 and not response.streaming:
+        response['ETag'] = etag
+    return response
+
+
+def _cache_entry(response):
+    """What is stored for a response, None for errors and streamed exports (those are not cached)"""
+    if response.status_code != 200 or response.streaming:
+        return None
+    if hasattr(response, 'render'):
+        with measure('render'): # rendered here instead of by Django, so the middleware would not see it
+            response.render()
+    return (response.content, response['Content-Type'])
@@ -0,0 +1,103 @@
+import random
+from datetime import date, timedelta
+from django.db import transaction
+from .models import *
+from .bulk import delete_without_signals
+from .cache import bump_versions
+from .counters import rebuild_all
+from .stats import rebuild_stats
+
+"""
+Synthetic catalogs for the benchmarks (management commands generate_catalog and run_benchmarks).
+Everything is written with bulk_create one batch of books at a time (the books, then their genre links, author links and copies),
+so memory stays at one batch and generating a million books is a few million INSERTs in one transaction instead of a million
+serializer round trips. The counters and the stats rollups are rebuilt set-based at the end. The same seed always gives the same catalog.
+Nothing is recorded in the change feed (changes.py), a new catalog starts with an empty log and clients download the lists again.
+"""
+
+SIZES = {'1k': 1000, '10k': 10000, '100k': 100000, '1m': 1000000}
+ROLES = ['writer', 'co-writer', 'editor', 'illustrator', 'translator']
+WORDS = ['river', 'shadow', 'garden', 'winter', 'empire', 'glass', 'storm', 'silent', 'golden', 'night', 'road', 'house']
+
+
+def parse_size(value):
+    """'1k', '100k', '1m' or a plain number of books"""
+    value = str(value).strip().lower()
+    if value in SIZES:
+        return SIZES[value]
+    if value.isdigit() and int(value) > 0:
+        return int(value)
+    raise ValueError(f"Unknown catalog size {value!r}, use a number or one of: {', '.join(SIZES)}")
+
+
+def flush_catalog():
+    """Deletes every booksys row with plain DELETEs (no signals, no loading the rows)"""
+    for queryset in (ChangeEvent.objects.all(), StatsDirty.objects.all(), GenreStats.objects.all(), YearStats.objects.all(), Copy.objects.all(),
+                     BookAuthor.objects.all(), Book.genres.through.objects.all(), Book.objects.all(), Author.objects.all(), Genre.objects.all()):
+        delete_without_signals(queryset)
+
+
+def _sentence(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words)).capitalize() + '.'
+
+
+def generate_catalog(books, authors=None, copies_per_book=2, authors_per_book=2, lent_ratio=0.3, overdue_ratio=0.1,
+                     seed=0, batch_size=5000, today=None):
+    """
+    Adds `books` books (titles "Book <n>") with 1..authors_per_book authors out of `authors` (default books // 3),
+    1-2 genres and 0..2*copies_per_book copies each. `lent_ratio` of the copies are lent and `overdue_ratio` of those are overdue.
+    Returns the number of rows written per model.
+    """
+    rng = random.Random(seed)
+    today = today or date.today()
+    authors = authors or max(1, books // 3)
+    counts = {'genres': 0, 'authors': 0, 'books': 0, 'book_authors': 0, 'book_genres': 0, 'copies': 0}
+
+    with transaction.atomic():
+        existing = set(Genre.objects.values_list('name', flat=True))
+        Genre.objects.bulk_create([Genre(name=name) for name in Genre.Genre_Choices.values if name not in existing])
+        counts['genres'] = len(Genre.Genre_Choices.values) - len(existing)
+        genre_ids = list(Genre.objects.values_list('pk', flat=True))
+
+        author_ids = []
+        for start in range(0, authors, batch_size):
+            batch = [
+                Author(name=f"Author {n}", introduction=_sentence(rng, 12), place_of_origin=rng.choice(WORDS).capitalize())
+                for n in range(start, min(start + batch_size, authors))
+            ]
+            author_ids += [author.pk for author in Author.objects.bulk_create(batch)]
+        counts['authors'] = authors
+
+        for start in range(0, books, batch_size):
+            batch = Book.objects.bulk_create([
+                Book(
+                    title=f"Book {n}", blurb=_sentence(rng, 30), rating=round(rng.uniform(0, 5), 1),
+                    date_published=date(1900, 1, 1) + timedelta(days=rng.randrange(45000)),
+                )
+                for n in range(start, min(start + batch_size, books))
+            ])
+            links, genre_links, copies = [], [], []
+            for book in batch:
+                for author_id in rng.sample(author_ids, min(len(author_ids), rng.randint(1, authors_per_book))):
+                    links.append(BookAuthor(book_id=book.pk, author_id=author_id, role=rng.choice(ROLES)))
+                for genre_id in rng.sample(genre_ids, rng.randint(1, 2)):
+                    genre_links.append(Book.genres.through(book_id=book.pk, genre_id=genre_id))
+                for _ in range(rng.randint(0, 2 * copies_per_book)):
+                    if rng.random() < lent_ratio:
+                        overdue = rng.random() < overdue_ratio
+                        days = -rng.randint(1, 60) if overdue else rng.randint(0, 30)
+                        copies.append(Copy(book_id=book.pk, lent=True, lent_by=f"Reader {rng.randrange(books)}", return_date=today + timedelta(days=days)))
+                    else:
+                        copies.append(Copy(book_id=book.pk))
+            BookAuthor.objects.bulk_create(links)
+            Book.genres.through.objects.bulk_create(genre_links)
+            Copy.objects.bulk_create(copies)
+            counts['books'] += len(batch)
+            counts['book_authors'] += len(links)
+            counts['book_genres'] += len(genre_links)
+            counts['copies'] += len(copies)
+
+        rebuild_all(batch_size=batch_size * 2) # bulk_create does not send the signals that keep the counters up to date
+        rebuild_stats()
+        bump_versions(Genre, Author, Book, BookAuthor, Copy)
+    return counts
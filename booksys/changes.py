@@ -0,0 +1,110 @@
+from django.db.models import Exists, OuterRef
+from rest_framework.exceptions import ValidationError
+from .models import *
+from .representations import AuthorValues, BookValues, CopyValues, GenreValues
+
+"""
+Change feed for incremental sync (/booksys/changes/?since=<cursor>).
+Every write of a genre, author, book or copy appends a ChangeEvent (kind, object id, upsert/delete) in the same transaction:
+signals.py for single object writes (serializers, views, admin, cascades), the counters for the books/authors whose denormalized
+columns moved, and the bulk code paths (bulk.py, lending.py) for what they write without signals. catalog.py's synthetic
+benchmark data is not logged.
+
+A page holds the events after `since` in id order, collapsed to the last event per object, with the current state of every
+object that still exists (the same output as the list views, built on the values() path) and a tombstone for the others.
+So a client that applies the pages in order ends up with the current catalog, in O(changes).
+compact() (command compact_changes) deletes the events that a later event of the same object supersedes, which never changes
+what any cursor reads, so the log stays O(objects + deletes) long.
+"""
+
+MODELS = {
+    ChangeEvent.Kind.GENRE: Genre,
+    ChangeEvent.Kind.AUTHOR: Author,
+    ChangeEvent.Kind.BOOK: Book,
+    ChangeEvent.Kind.COPY: Copy,
+}
+KINDS = {model: kind for kind, model in MODELS.items()}
+REPRESENTATIONS = {
+    ChangeEvent.Kind.GENRE: GenreValues,
+    ChangeEvent.Kind.AUTHOR: AuthorValues,
+    ChangeEvent.Kind.BOOK: BookValues,
+    ChangeEvent.Kind.COPY: CopyValues,
+}
+
+
+def record(model, ids, action=ChangeEvent.Action.UPSERT):
+    """Appends one event per object (duplicates in `ids` are dropped)"""
+    ids = [pk for pk in dict.fromkeys(ids) if pk is not None]
+    if ids:
+        ChangeEvent.objects.bulk_create([ChangeEvent(kind=KINDS[model], object_id=pk, action=action) for pk in ids])
+
+
+def record_deleted(model, ids):
+    record(model, ids, ChangeEvent.Action.DELETE)
+
+
+def record_books(book_ids, copies=False, authors=False):
+    """The books, plus the copies (book_info) and/or authors (authored_books) that show their title/rating/genres"""
+    book_ids = [pk for pk in dict.fromkeys(book_ids) if pk is not None]
+    record(Book, book_ids)
+    if copies and book_ids:
+        record(Copy, Copy.objects.filter(book_id__in=book_ids).values_list('pk', flat=True))
+    if authors and book_ids:
+        record(Author, BookAuthor.objects.filter(book_id__in=book_ids).values_list('author_id', flat=True))
+
+
+def latest_cursor():
+    return ChangeEvent.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+
+
+def parse_since(value):
+    try:
+        since = int(value)
+    except (TypeError, ValueError):
+        raise ValidationError({'since': "Must be a cursor returned by /changes/."})
+    if since < 0:
+        raise ValidationError({'since': "Must be a cursor returned by /changes/."})
+    return since
+
+
+def _states(kind, ids):
+    """{id: current representation} of the objects that still exist"""
+    representation = REPRESENTATIONS[kind]()
+    rows = list(representation.values(MODELS[kind].objects.filter(pk__in=ids)))
+    return {row['id']: data for row, data in zip(rows, representation.data(rows))}
+
+
+def changes_since(since, limit):
+    """One page of the feed: {'changes': [...], 'cursor': the `since` of the next page, 'has_more': bool}"""
+    events = list(ChangeEvent.objects.filter(pk__gt=since).order_by('pk').values_list('pk', 'kind', 'object_id', 'action')[:limit + 1])
+    has_more = len(events) > limit
+    events = events[:limit]
+    if not events:
+        return {'changes': [], 'cursor': since, 'has_more': False}
+
+    latest = {} # (kind, id) -> (cursor, action), in the order of their last event
+    for pk, kind, object_id, action in events:
+        latest.pop((kind, object_id), None)
+        latest[(kind, object_id)] = (pk, action)
+
+    states = {}
+    for kind in REPRESENTATIONS:
+        ids = [object_id for (event_kind, object_id), (_, action) in latest.items() if event_kind == kind and action == ChangeEvent.Action.UPSERT]
+        if ids:
+            states[kind] = _states(kind, ids)
+
+    changes = []
+    for (kind, object_id), (pk, action) in latest.items():
+        data = states.get(kind, {}).get(object_id)
+        if data is None: # deleted, possibly by an event after this page
+            changes.append({'cursor': pk, 'type': kind, 'id': object_id, 'action': ChangeEvent.Action.DELETE})
+        else:
+            changes.append({'cursor': pk, 'type': kind, 'id': object_id, 'action': ChangeEvent.Action.UPSERT, 'data': data})
+    return {'changes': changes, 'cursor': events[-1][0], 'has_more': has_more}
+
+
+def compact():
+    """Deletes every event a later event of the same object supersedes, returns how many"""
+    later = ChangeEvent.objects.filter(kind=OuterRef('kind'), object_id=OuterRef('object_id'), pk__gt=OuterRef('pk'))
+    deleted, _ = ChangeEvent.objects.filter(Exists(later)).delete()
+    return deleted
@@ -0,0 +1,103 @@
+import math
+from django.db.models import Avg, Count, IntegerField, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce
+from .models import *
+from .cache import bump_versions
+from .changes import record
+
+"""
+Maintenance of the denormalized columns (Book.num_copies/num_available/num_lent and Author.avg_rating).
+Only the rows that are affected by a write are recomputed, with one UPDATE using correlated subqueries,
+so a write costs the same no matter how big the catalog is and the list views never need a GROUP BY.
+signals.py calls these for single object writes, bulk code paths call them once per batch.
+The refreshed rows also go to the change feed (changes.py), rebuild_all only fixes drift and does not.
+"""
+
+
+def _count_copies(**filters):
+    copies = Copy.objects.filter(book=OuterRef('pk'), **filters).order_by().values('book').annotate(count=Count('pk')).values('count')
+    return Coalesce(Subquery(copies, output_field=IntegerField()), Value(0))
+
+
+def book_counter_expressions():
+    return {
+        'num_copies': _count_copies(),
+        'num_available': _count_copies(lent=False),
+        'num_lent': _count_copies(lent=True),
+    }
+
+
+def author_rating_expressions():
+    ratings = BookAuthor.objects.filter(author=OuterRef('pk')).order_by().values('author').annotate(avg=Avg('book__rating')).values('avg')
+    return {'avg_rating': Subquery(ratings)}
+
+
+def _ids(ids):
+    return {pk for pk in ids if pk is not None}
+
+
+def refresh_book_counters(book_ids):
+    """Recompute the copy counts of the given books"""
+    book_ids = _ids(book_ids)
+    if book_ids:
+        Book.objects.filter(pk__in=book_ids).update(**book_counter_expressions())
+        bump_versions(Book)
+        record(Book, book_ids)
+
+
+def refresh_author_ratings(author_ids):
+    """Recompute the average rating of the given authors"""
+    author_ids = _ids(author_ids)
+    if author_ids:
+        Author.objects.filter(pk__in=author_ids).update(**author_rating_expressions())
+        bump_versions(Author)
+        record(Author, author_ids)
+
+
+def refresh_ratings_for_books(book_ids):
+    """A book's rating changed (or it was linked/unlinked) so every author of it needs a new average"""
+    book_ids = _ids(book_ids)
+    if book_ids:
+        refresh_author_ratings(BookAuthor.objects.filter(book__in=book_ids).values_list('author', flat=True).distinct())
+
+
+def _batches(model, batch_size):
+    """pk ranges so a full rebuild never touches more than batch_size rows in one statement"""
+    last = model.objects.order_by('-pk').values_list('pk', flat=True).first()
+    if last is None:
+        return
+    for start in range(0, last + 1, batch_size):
+        yield model.objects.filter(pk__gte=start, pk__lt=start + batch_size)
+
+
+def rebuild_all(batch_size=10000):
+    for books in _batches(Book, batch_size):
+        books.update(**book_counter_expressions())
+    for authors in _batches(Author, batch_size):
+        authors.update(**author_rating_expressions())
+    bump_versions(Book, Author)
+
+
+def find_mismatches(batch_size=10000):
+    """Yields (model name, pk, field, stored value, actual value) for every counter that is out of date"""
+    for books in _batches(Book, batch_size):
+        rows = books.annotate(
+            actual_copies=Count('copies'),
+            actual_lent=Count('copies', filter=Q(copies__lent=True)),
+        ).values_list('pk', 'num_copies', 'num_available', 'num_lent', 'actual_copies', 'actual_lent')
+        for pk, num_copies, num_available, num_lent, actual_copies, actual_lent in rows:
+            actual = {'num_copies': actual_copies, 'num_available': actual_copies - actual_lent, 'num_lent': actual_lent}
+            stored = {'num_copies': num_copies, 'num_available': num_available, 'num_lent': num_lent}
+            for field in actual:
+                if stored[field] != actual[field]:
+                    yield 'Book', pk, field, stored[field], actual[field]
+
+    for authors in _batches(Author, batch_size):
+        rows = authors.annotate(actual=Avg('authored_books__book__rating')).values_list('pk', 'avg_rating', 'actual')
+        for pk, stored, actual in rows:
+            if stored is None or actual is None:
+                matches = stored is None and actual is None
+            else:
+                matches = math.isclose(stored, actual)
+            if not matches:
+                yield 'Author', pk, 'avg_rating', stored, actual
@@ -0,0 +1,39 @@
+from django.conf import settings
+
+"""
+Per connection SQLite settings, applied when Django opens a connection (connection_created, connected in apps.py).
+The defaults (BOOKSYS_SQLITE_PRAGMAS) only change the connection, never the database file:
+    mmap_size               read the file through memory mapping instead of read() calls
+    busy_timeout            wait up to this many ms for a lock instead of failing right away with "database is locked"
+BOOKSYS_SQLITE_WAL = True also switches the file to WAL (readers no longer wait for a writer, and a writer not for readers)
+with synchronous=normal (safe with WAL, no fsync on every commit). The journal mode is stored in the database file itself,
+so it is off by default: a deployment turns it on for its own database, the db.sqlite3 checked into the repo stays as it is.
+"""
+
+DEFAULT_PRAGMAS = {
+    'mmap_size': 256 * 1024 * 1024,
+    'busy_timeout': 5000,
+}
+WAL_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+}
+FILE_ONLY_PRAGMAS = {'journal_mode', 'mmap_size'} # meaningless for in-memory databases (the test database)
+
+
+def pragmas():
+    pragmas = dict(getattr(settings, 'BOOKSYS_SQLITE_PRAGMAS', DEFAULT_PRAGMAS))
+    if getattr(settings, 'BOOKSYS_SQLITE_WAL', False):
+        pragmas.update(WAL_PRAGMAS)
+    return pragmas
+
+
+def configure_sqlite(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite':
+        return
+    in_memory = connection.is_in_memory_db()
+    for name, value in pragmas().items():
+        if in_memory and name in FILE_ONLY_PRAGMAS:
+            continue
+        # on the raw sqlite3 connection, like Django's own PRAGMA foreign_keys, so it is not logged/counted as a query
+        connection.connection.execute(f'PRAGMA {name} = {value}')
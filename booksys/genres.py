@@ -0,0 +1,67 @@
+import threading
+from django.db import connection
+from .models import *
+from .cache import get_versions
+
+"""
+In-process table of the genres. Genre is a handful of rows (Genre_Choices) that almost never change, so instead of a query
+(or a join) every time a genre is looked up by name/ID, rendered or filtered on, every process keeps all of them in memory:
+GenreLookupField and the bulk upsert resolve references from it, the values() read path renders genre names from the
+book -> genre_id links without joining the genre table, and ?genres=/?genre= filter on genre_id IN (...) instead of comparing names.
+
+It is reloaded (one query) when the Genre version counter in the response cache (cache.py) moved, which every genre write bumps,
+so a write in one process is seen by the others (book <-> genre link changes don't touch it). The Genre
+post_save/post_delete signals (GenreListView.post, the admin) also drop it right away in the process that wrote.
+It is never filled from inside a transaction: the rows would include that transaction's own uncommitted writes, which may
+still be rolled back. table() then returns None and the callers query the database as before.
+"""
+
+
+class GenreTable:
+    def __init__(self, genres):
+        self.by_pk = {genre.pk: genre for genre in genres}
+        self.by_name = {genre.name: genre for genre in genres}
+
+    def get(self, value):
+        """The genre with this ID (int) or name (str), None if there is none"""
+        return self.by_pk.get(value) if isinstance(value, int) else self.by_name.get(value)
+
+    def ids_named(self, name):
+        # the case insensitive match of the name filters (genres__name__lower=Lower(name))
+        return [genre.pk for genre in self.by_pk.values() if genre.name.lower() == name.lower()]
+
+    def name(self, pk):
+        return self.by_pk[pk].name
+
+
+class GenreRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._table = None
+        self._version = None
+
+    def clear(self):
+        with self._lock:
+            self._table = None
+            self._version = None
+
+    def table(self):
+        """The current GenreTable, or None when it would have to be (re)loaded inside a transaction"""
+        version = get_versions([Genre])[0]
+        with self._lock:
+            if self._table is not None and self._version == version:
+                return self._table
+            if connection.in_atomic_block:
+                return None
+            self._table = GenreTable(list(Genre.objects.all()))
+            self._version = version
+            return self._table
+
+
+GENRES = GenreRegistry()
+
+
+def genre_ids_named(name):
+    """The IDs of the genres called `name` (any case), None when the registry can't be used"""
+    table = GENRES.table()
+    return None if table is None else table.ids_named(name)
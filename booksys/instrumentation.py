@@ -0,0 +1,144 @@
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from django.conf import settings
+
+"""
+Per request numbers for the booksys API: SQL queries and time spent in the db (counted by an execute_wrapper around every
+statement), serializer time, rendering time and the slowest statement. The middleware (middleware.py) creates a RequestStats
+for each request and puts it in a context variable; the serializers (TimedSerializerMixin) and the response cache add their timings to it when
+there is one and do nothing otherwise. Finished requests are added to per endpoint samples that /booksys/metrics/ turns
+into p50/p95/p99.
+"""
+
+_current = ContextVar('booksys_request_stats', default=None)
+
+
+def is_enabled():
+    return getattr(settings, 'BOOKSYS_INSTRUMENTATION', False)
+
+
+def current_stats():
+    return _current.get()
+
+
+class RequestStats:
+    def __init__(self):
+        self.view = None
+        self.queries = 0
+        self.db_time = 0.0
+        self.serializer_time = 0.0
+        self.render_time = 0.0
+        self.total_time = 0.0
+        self.slowest_sql = None
+        self.slowest_time = 0.0
+        self._started = time.perf_counter()
+
+    def execute_wrapper(self, execute, sql, params, many, context):
+        """For connection.execute_wrapper(), times every statement the request runs"""
+        if _current.get() is not self: # another request's statement on a shared connection (async requests without their own thread)
+            return execute(sql, params, many, context)
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.queries += 1
+            self.db_time += elapsed
+            if elapsed > self.slowest_time:
+                self.slowest_time = elapsed
+                self.slowest_sql = sql
+
+    def add(self, part, seconds):
+        setattr(self, f'{part}_time', getattr(self, f'{part}_time') + seconds)
+
+    def finish(self):
+        self.total_time = time.perf_counter() - self._started
+
+    def header(self):
+        """The X-Booksys-Stats debug header, times in ms (no SQL, that only goes to the log)"""
+        return (
+            f'view={self.view};queries={self.queries};db={self.db_time * 1000:.2f};serializer={self.serializer_time * 1000:.2f};'
+            f'render={self.render_time * 1000:.2f};total={self.total_time * 1000:.2f}'
+        )
+
+
+def activate(stats):
+    return _current.set(stats)
+
+
+def deactivate(token):
+    _current.reset(token)
+
+
+@contextmanager
+def measure(part):
+    """Adds the time of the block to `<part>_time` of the current request, if it is instrumented"""
+    stats = _current.get()
+    if stats is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats.add(part, time.perf_counter() - started)
+
+
+def _percentile(ordered, fraction):
+    # nearest rank on an already sorted list
+    index = min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+
+class EndpointMetrics:
+    """The last BOOKSYS_METRICS_SAMPLES requests of every endpoint, so memory is bounded no matter how long the process runs"""
+    series = ('total_ms', 'db_ms', 'queries', 'serializer_ms', 'render_ms')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._samples = defaultdict(self._new_endpoint)
+        self._counts = defaultdict(int)
+
+    def _new_endpoint(self):
+        size = getattr(settings, 'BOOKSYS_METRICS_SAMPLES', 1000)
+        return {name: deque(maxlen=size) for name in self.series}
+
+    def record(self, endpoint, stats):
+        values = {
+            'total_ms': stats.total_time * 1000,
+            'db_ms': stats.db_time * 1000,
+            'queries': stats.queries,
+            'serializer_ms': stats.serializer_time * 1000,
+            'render_ms': stats.render_time * 1000,
+        }
+        with self._lock:
+            samples = self._samples[endpoint]
+            for name, value in values.items():
+                samples[name].append(value)
+            self._counts[endpoint] += 1
+
+    def snapshot(self):
+        with self._lock:
+            copied = {endpoint: {name: sorted(values) for name, values in samples.items()} for endpoint, samples in self._samples.items()}
+            counts = dict(self._counts)
+        result = {}
+        for endpoint, samples in sorted(copied.items()):
+            result[endpoint] = {'count': counts[endpoint]}
+            for name, ordered in samples.items():
+                result[endpoint][name] = {
+                    'p50': round(_percentile(ordered, 0.50), 3),
+                    'p95': round(_percentile(ordered, 0.95), 3),
+                    'p99': round(_percentile(ordered, 0.99), 3),
+                }
+        return result
+
+    def reset(self):
+        with self._lock:
+            self._samples.clear()
+            self._counts.clear()
+
+
+METRICS = EndpointMetrics()
@@ -0,0 +1,192 @@
+import random
+import time
+from collections import defaultdict
+from functools import wraps
+from django.conf import settings
+from django.db import OperationalError, transaction
+from rest_framework import serializers
+from .models import *
+from .cache import bump_versions
+from .counters import refresh_book_counters
+from .stats import mark_books
+from .changes import record
+
+"""
+Checkout/return of copies without a read-modify-write: a copy is claimed with one conditional UPDATE
+(`... SET lent = true WHERE id = %s AND lent = false`), so when two librarians lend the same copy at the same time
+exactly one UPDATE matches the row and the other one sees 0 rows and gets a conflict.
+The batch versions (checkout_batch/return_batch) read the state of all the copies once and then claim the ones that can
+make the transition with one UPDATE ... WHERE id IN (...) AND lent = ... per batch, the others are reported per id.
+"""
+
+
+class LendingConflict(Exception):
+    pass
+
+
+class CheckoutSerializer(serializers.Serializer):
+    """The same rule as CopySerializer.validate: lending needs who borrowed it and when it is due back"""
+    lent_by = serializers.CharField(max_length=255)
+    return_date = serializers.DateField()
+
+
+def is_lock_error(error):
+    message = str(error).lower()
+    return 'locked' in message or 'busy' in message
+
+
+def retry_on_lock(func):
+    """Retries a short write a bounded number of times when SQLite reports the database (or a table) as locked"""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        retries = getattr(settings, 'BOOKSYS_LOCK_RETRIES', 5)
+        delay = getattr(settings, 'BOOKSYS_LOCK_RETRY_DELAY', 0.05)
+        for attempt in range(retries + 1):
+            try:
+                return func(*args, **kwargs)
+            except OperationalError as error:
+                if attempt == retries or not is_lock_error(error):
+                    raise
+                time.sleep(delay * (2 ** attempt) * random.uniform(0.5, 1.5)) # backoff with jitter so the retries do not collide again
+    return wrapper
+
+
+def _claim(queryset, **values):
+    """The conditional UPDATE, True if this call changed the row"""
+    return queryset.update(**values) == 1
+
+
+def _written(copy_id, book_id):
+    # update() does not send the signals
+    refresh_book_counters([book_id])
+    mark_books([book_id])
+    bump_versions(Copy)
+    record(Copy, [copy_id])
+
+
+@retry_on_lock
+def checkout(copy_id, lent_by, return_date):
+    with transaction.atomic():
+        if not _claim(Copy.objects.filter(pk=copy_id, lent=False), lent=True, lent_by=lent_by, return_date=return_date):
+            if not Copy.objects.filter(pk=copy_id).exists():
+                raise Copy.DoesNotExist
+            raise LendingConflict("This copy is already lent.")
+        _written(copy_id, Copy.objects.filter(pk=copy_id).values_list('book_id', flat=True).first())
+
+
+@retry_on_lock
+def return_copy(copy_id):
+    with transaction.atomic():
+        if not _claim(Copy.objects.filter(pk=copy_id, lent=True), lent=False, lent_by=None, return_date=None):
+            if not Copy.objects.filter(pk=copy_id).exists():
+                raise Copy.DoesNotExist
+            raise LendingConflict("This copy is not lent.")
+        _written(copy_id, Copy.objects.filter(pk=copy_id).values_list('book_id', flat=True).first())
+
+
+@retry_on_lock
+def checkout_any(book_id, lent_by, return_date):
+    """Lends any available copy of the book and returns its id"""
+    attempts = getattr(settings, 'BOOKSYS_CHECKOUT_ATTEMPTS', 10)
+    for _ in range(attempts):
+        with transaction.atomic():
+            # pick among a few free copies so concurrent checkouts of the same book do not all race for the first one
+            candidates = list(Copy.objects.filter(book_id=book_id, lent=False).order_by('pk').values_list('pk', flat=True)[:10])
+            if not candidates:
+                raise LendingConflict("No copy of this book is available.")
+            copy_id = random.choice(candidates)
+            if _claim(Copy.objects.filter(pk=copy_id, lent=False), lent=True, lent_by=lent_by, return_date=return_date):
+                _written(copy_id, book_id)
+                return copy_id
+    raise LendingConflict("Could not claim a copy of this book, try again.")
+
+
+class BatchReturnSerializer(serializers.Serializer):
+    ids = serializers.ListField(child=serializers.IntegerField(min_value=1), allow_empty=False)
+
+    def validate_ids(self, value):
+        if len(set(value)) != len(value):
+            raise serializers.ValidationError("Each copy can only be given once.")
+        return value
+
+
+class BatchCheckoutItemSerializer(CheckoutSerializer):
+    id = serializers.IntegerField(min_value=1)
+
+
+class BatchCheckoutSerializer(serializers.Serializer):
+    """
+    Either `ids` lent to one `lent_by` until one `return_date`, or `copies`: [{id, lent_by, return_date}].
+    The whole batch is validated before anything is written, with CheckoutSerializer's rule for every copy.
+    """
+    ids = serializers.ListField(child=serializers.IntegerField(min_value=1), allow_empty=False, required=False)
+    lent_by = serializers.CharField(max_length=255, required=False)
+    return_date = serializers.DateField(required=False)
+    copies = BatchCheckoutItemSerializer(many=True, allow_empty=False, required=False)
+
+    def validate(self, data):
+        if ('ids' in data) == ('copies' in data):
+            raise serializers.ValidationError("Give either ids (with lent_by and return_date) or copies.")
+        if 'ids' in data:
+            for field in ('lent_by', 'return_date'):
+                if not data.get(field):
+                    raise serializers.ValidationError({field: "This field is required when the book is lent."})
+            entries = [(pk, data['lent_by'], data['return_date']) for pk in data['ids']]
+        else:
+            entries = [(item['id'], item['lent_by'], item['return_date']) for item in data['copies']]
+        if len({pk for pk, _, _ in entries}) != len(entries):
+            raise serializers.ValidationError("Each copy can only be given once.")
+        return {'entries': entries}
+
+
+def _chunks(ids):
+    size = getattr(settings, 'BOOKSYS_BULK_BATCH_SIZE', 1000)
+    ids = list(ids)
+    return [ids[start:start + size] for start in range(0, len(ids), size)]
+
+
+@retry_on_lock
+def _transition(changes, from_lent, conflict):
+    """
+    `changes` is {copy id: values to set} for copies that must currently have lent == from_lent.
+    Returns {'applied': [ids], 'errors': [{'id', 'detail'}]} in the order of `changes`.
+    """
+    with transaction.atomic():
+        current = {}
+        for chunk in _chunks(changes):
+            # select_for_update: on SQLite the IMMEDIATE transaction already holds the write lock, elsewhere it locks the rows
+            rows = Copy.objects.select_for_update().filter(pk__in=chunk).values_list('pk', 'lent', 'book_id')
+            current.update((pk, (lent, book_id)) for pk, lent, book_id in rows)
+
+        applied, errors = [], []
+        groups = defaultdict(list) # one UPDATE per distinct set of values (usually one)
+        for pk, values in changes.items():
+            if pk not in current:
+                errors.append({'id': pk, 'detail': "Not found."})
+            elif current[pk][0] != from_lent:
+                errors.append({'id': pk, 'detail': conflict})
+            else:
+                applied.append(pk)
+                groups[tuple(values.items())].append(pk)
+        for values, pks in groups.items():
+            for chunk in _chunks(pks):
+                Copy.objects.filter(pk__in=chunk, lent=from_lent).update(**dict(values))
+
+        if applied:
+            book_ids = {current[pk][1] for pk in applied}
+            refresh_book_counters(book_ids)
+            mark_books(book_ids)
+            bump_versions(Copy)
+            record(Copy, applied)
+    return {'applied': applied, 'errors': errors}
+
+
+def checkout_batch(entries):
+    """Lends every (copy id, lent_by, return_date) whose copy is available"""
+    changes = {pk: {'lent': True, 'lent_by': lent_by, 'return_date': return_date} for pk, lent_by, return_date in entries}
+    return _transition(changes, False, "This copy is already lent.")
+
+
+def return_batch(ids):
+    changes = {pk: {'lent': False, 'lent_by': None, 'return_date': None} for pk in ids}
+    return _transition(changes, True, "This copy is not lent.")
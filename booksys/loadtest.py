@@ -0,0 +1,104 @@
+import asyncio
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.db import connections
+from django.test import AsyncClient, Client
+from django.urls import reverse
+from .benchmarks import CASES, url_args
+
+"""
+Throughput of the read endpoints with many requests in flight at once (management command load_test), three ways:
+    wsgi        the DRF views through the WSGI handler, one thread per concurrent client (like a threaded WSGI server)
+    asgi-sync   the DRF views through the ASGI handler, which has to run every one of them in the sync_to_async thread
+    asgi-async  the async views (async_views.py) through the ASGI handler
+Requests go through Django's test clients, in process, so the numbers compare the handlers and views, not a network stack.
+"""
+
+DEFAULT_CASES = ['book-list page', 'author-list page', 'book-detail one', 'copy-list page']
+
+
+def requests_for(labels, prefix=''):
+    """(url, params) of each benchmark case label, with `prefix` ('async-') for the async endpoints"""
+    args = url_args()
+    requests = []
+    for label in labels:
+        name, case_name = label.split(' ', 1)
+        name = prefix + name
+        cases = [case for case in CASES.get(name, []) if case[0] == case_name and case[1] == 'GET']
+        if not cases:
+            raise ValueError(f"No GET benchmark case {prefix}{label!r}")
+        url = reverse(name, args=[args[name]]) if name in args else reverse(name)
+        requests.append((url, cases[0][2]))
+    return requests
+
+
+def summarize(latencies, errors, elapsed):
+    ordered = sorted(latencies)
+    def percentile(fraction):
+        return round(ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))], 3) if ordered else None
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'seconds': round(elapsed, 3),
+        'requests_per_second': round(len(latencies) / elapsed, 1) if elapsed else None,
+        'latency_ms': {
+            'p50': percentile(0.50), 'p95': percentile(0.95), 'p99': percentile(0.99),
+            'mean': round(statistics.fmean(ordered), 3) if ordered else None,
+        },
+    }
+
+
+def run_wsgi(requests, total, concurrency):
+    def worker(indexes):
+        client = Client()
+        latencies, errors = [], 0
+        try:
+            for index in indexes:
+                url, params = requests[index % len(requests)]
+                started = time.perf_counter()
+                response = client.get(url, params)
+                latencies.append((time.perf_counter() - started) * 1000)
+                errors += response.status_code >= 400
+        finally:
+            connections.close_all() # this thread's connections
+        return latencies, errors
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(worker, [range(worker, total, concurrency) for worker in range(concurrency)]))
+    elapsed = time.perf_counter() - started
+    return summarize([latency for latencies, _ in results for latency in latencies], sum(errors for _, errors in results), elapsed)
+
+
+async def _run_asgi(requests, total, concurrency):
+    client = AsyncClient()
+    latencies, errors = [], 0
+    index = 0
+
+    async def worker():
+        nonlocal errors, index
+        while index < total:
+            url, params = requests[index % len(requests)]
+            index += 1
+            started = time.perf_counter()
+            response = await client.get(url, params)
+            latencies.append((time.perf_counter() - started) * 1000)
+            errors += response.status_code >= 400
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(latencies, errors, time.perf_counter() - started)
+
+
+def run_asgi(requests, total, concurrency):
+    return asyncio.run(_run_asgi(requests, total, concurrency))
+
+
+def run_all(labels=DEFAULT_CASES, total=500, concurrency=50):
+    sync_requests = requests_for(labels)
+    return {
+        'wsgi': run_wsgi(sync_requests, total, concurrency),
+        'asgi-sync': run_asgi(sync_requests, total, concurrency),
+        'asgi-async': run_asgi(requests_for(labels, prefix='async-'), total, concurrency),
+    }
@@ -0,0 +1,93 @@
+from django.db.models import Q
+from .models import *
+
+"""
+Identity map shared by the lookup fields (AuthorLookupField, BookLookupField, GenreLookupField) for one request.
+It lives in the root serializer's context, which is copied into the nested serializers the fields create, so every
+field in one payload sees the same cache. The first lookup of a model walks the whole payload and loads every
+reference to that model with one query, objects created while saving the payload are added to it as well.
+"""
+
+# the field used when a reference is a name
+NAME_FIELDS = {
+    Author: 'name',
+    Book: 'title',
+    Genre: 'name',
+}
+
+# payload keys that hold references (a single one or a list) to each model
+PAYLOAD_KEYS = {
+    'author': Author,
+    'book': Book,
+    'genres': Genre,
+}
+
+
+class LookupCache:
+    context_key = 'lookup_cache'
+
+    def __init__(self, payload):
+        self.payload = payload
+        self.objects = {} # (model, 'pk' or 'name', value) -> object
+        self.searched = set() # keys that were looked up in the db, so a miss is known to be missing
+        self.prewarmed = set()
+
+    @classmethod
+    def for_field(cls, field):
+        """The cache of the request the field is validating, created on first use from the root serializer's payload"""
+        context = field.root.context
+        cache = context.get(cls.context_key)
+        if cache is None:
+            cache = context[cls.context_key] = cls(getattr(field.root, 'initial_data', None))
+        return cache
+
+    @staticmethod
+    def key(model, value):
+        return (model, 'pk' if isinstance(value, int) else 'name', value)
+
+    def collect(self, data, model, refs):
+        """Walks the payload and gathers every ID/name used to reference the model"""
+        if isinstance(data, list):
+            for item in data:
+                self.collect(item, model, refs)
+        elif isinstance(data, dict):
+            for key, value in data.items():
+                if PAYLOAD_KEYS.get(key) is model:
+                    for ref in value if isinstance(value, list) else [value]:
+                        if isinstance(ref, dict):
+                            ref = ref.get(NAME_FIELDS[model])
+                        if isinstance(ref, (int, str)) and not isinstance(ref, bool):
+                            refs.add(ref)
+                self.collect(value, model, refs)
+
+    def prewarm(self, model):
+        if model in self.prewarmed:
+            return
+        self.prewarmed.add(model)
+        refs = set()
+        self.collect(self.payload, model, refs)
+        self.load(model, refs)
+
+    def load(self, model, refs):
+        """One query for all the refs, remembers what was found and what was not"""
+        name_field = NAME_FIELDS[model]
+        ids = {ref for ref in refs if isinstance(ref, int)}
+        names = {ref for ref in refs if isinstance(ref, str)}
+        if not refs:
+            return
+        for obj in model.objects.filter(Q(pk__in=ids) | Q(**{f'{name_field}__in': names})):
+            self.add(obj)
+        self.searched.update(self.key(model, ref) for ref in refs)
+
+    def add(self, obj):
+        model = type(obj)
+        self.objects[(model, 'pk', obj.pk)] = obj
+        self.objects[(model, 'name', getattr(obj, NAME_FIELDS[model]))] = obj
+
+    def get(self, model, value):
+        """The object with this ID (int) or name (str), or None if it does not exist"""
+        self.prewarm(model)
+        key = self.key(model, value)
+        if key not in self.objects and key not in self.searched:
+            self.load(model, {value}) # a reference that was not in the payload (e.g. from a custom context)
+        return self.objects.get(key)
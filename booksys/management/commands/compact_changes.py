@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from booksys.changes import compact
+
+
+class Command(BaseCommand):
+    help = "Deletes the change feed events that a later event of the same object supersedes"
+
+    def handle(self, *args, **options):
+        deleted = compact()
+        self.stdout.write(self.style.SUCCESS(f"Change feed compacted ({deleted} events deleted)."))
@@ -0,0 +1,43 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from booksys.catalog import flush_catalog, generate_catalog, parse_size
+from booksys.models import *
+
+
+class Command(BaseCommand):
+    help = "Fills the database with a synthetic catalog (books, authors, genres, copies, loans) for benchmarking"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', default='1k', help="Number of books: 1k, 10k, 100k, 1m or any number")
+        parser.add_argument('--authors', type=int, help="Number of authors, default a third of the books")
+        parser.add_argument('--copies-per-book', type=int, default=2, help="Average copies per book")
+        parser.add_argument('--authors-per-book', type=int, default=2, help="Maximum authors per book")
+        parser.add_argument('--lent-ratio', type=float, default=0.3, help="Fraction of the copies that are lent")
+        parser.add_argument('--overdue-ratio', type=float, default=0.1, help="Fraction of the lent copies that are overdue")
+        parser.add_argument('--seed', type=int, default=0, help="Same seed, same catalog")
+        parser.add_argument('--batch-size', type=int, default=5000, help="Books per round of bulk inserts")
+        parser.add_argument('--flush', action='store_true', help="Delete the existing booksys data first")
+
+    def handle(self, *args, **options):
+        try:
+            books = parse_size(options['size'])
+        except ValueError as error:
+            raise CommandError(str(error))
+        for ratio in ('lent_ratio', 'overdue_ratio'):
+            if not 0 <= options[ratio] <= 1:
+                raise CommandError(f"--{ratio.replace('_', '-')} must be between 0 and 1")
+        if options['batch_size'] < 1:
+            raise CommandError("--batch-size must be at least 1")
+
+        if options['flush']:
+            flush_catalog()
+        elif Book.objects.exists() or Author.objects.exists():
+            raise CommandError("The catalog is not empty, use --flush to replace it")
+
+        started = time.perf_counter()
+        counts = generate_catalog(
+            books, authors=options['authors'], copies_per_book=options['copies_per_book'], authors_per_book=options['authors_per_book'],
+            lent_ratio=options['lent_ratio'], overdue_ratio=options['overdue_ratio'], seed=options['seed'], batch_size=options['batch_size'],
+        )
+        summary = ', '.join(f"{count} {name}" for name, count in counts.items())
+        self.stdout.write(self.style.SUCCESS(f"Generated {summary} in {time.perf_counter() - started:.1f}s."))
@@ -0,0 +1,59 @@
+import json
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import setup_databases, setup_test_environment, teardown_databases, teardown_test_environment
+from booksys.catalog import generate_catalog, parse_size
+from booksys.loadtest import DEFAULT_CASES, run_all
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares the throughput of the read endpoints under WSGI, under ASGI with the sync views and under ASGI with the async "
+        "views at high concurrency, against a generated catalog in a fresh test database"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', default='1k', help="Catalog size (books)")
+        parser.add_argument('--requests', type=int, default=500, help="Requests per mode")
+        parser.add_argument('--concurrency', type=int, default=50, help="Requests in flight at once")
+        parser.add_argument('--cases', default=','.join(DEFAULT_CASES), help="Comma separated benchmark case names to cycle through")
+        parser.add_argument('--cache', action='store_true', help="Keep the response cache on")
+        parser.add_argument('--test-db-file', help="SQLite file for the test database instead of memory")
+        parser.add_argument('--output', help="Write the results as JSON to this file")
+
+    def handle(self, *args, **options):
+        try:
+            books = parse_size(options['size'])
+        except ValueError as error:
+            raise CommandError(str(error))
+        if options['requests'] < 1 or options['concurrency'] < 1:
+            raise CommandError("--requests and --concurrency must be at least 1")
+        if options['test_db_file']:
+            connection.settings_dict.setdefault('TEST', {})['NAME'] = options['test_db_file']
+
+        setup_test_environment()
+        old_config = setup_databases(verbosity=0, interactive=False, aliases={'default'})
+        try:
+            generate_catalog(books)
+            with override_settings(BOOKSYS_RESPONSE_CACHE=options['cache']):
+                results = run_all(
+                    [case.strip() for case in options['cases'].split(',')], total=options['requests'], concurrency=options['concurrency'],
+                )
+        except ValueError as error:
+            raise CommandError(str(error))
+        finally:
+            teardown_databases(old_config, verbosity=0)
+            teardown_test_environment()
+
+        for mode, result in results.items():
+            self.stderr.write(
+                f"{mode:<11} {result['requests_per_second']:>8} req/s  p50 {result['latency_ms']['p50']:>9}ms  "
+                f"p99 {result['latency_ms']['p99']:>9}ms  {result['errors']} errors"
+            )
+        report = {'size': options['size'], 'concurrency': options['concurrency'], 'results': results}
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                json.dump(report, file, indent=2)
+        else:
+            self.stdout.write(json.dumps(report, indent=2))
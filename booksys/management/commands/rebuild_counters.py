@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from booksys.counters import find_mismatches, rebuild_all
+
+
+class Command(BaseCommand):
+    help = "Rebuilds (or with --verify only checks) the denormalized copy counts of books and average ratings of authors"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verify', action='store_true', help="Only report counters that are out of date, do not change anything")
+        parser.add_argument('--batch-size', type=int, default=10000, help="Rows per UPDATE/SELECT")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError("--batch-size must be at least 1")
+
+        if not options['verify']:
+            with transaction.atomic():
+                rebuild_all(batch_size=batch_size)
+            self.stdout.write(self.style.SUCCESS("Counters rebuilt."))
+
+        mismatches = 0
+        for model, pk, field, stored, actual in find_mismatches(batch_size=batch_size):
+            mismatches += 1
+            self.stdout.write(f"{model} {pk}: {field} is {stored}, should be {actual}")
+
+        if mismatches:
+            raise CommandError(f"{mismatches} counter(s) out of date")
+        self.stdout.write(self.style.SUCCESS("All counters are up to date."))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from booksys.stats import rebuild_stats, refresh_dirty
+
+
+class Command(BaseCommand):
+    help = "Recomputes the /stats/ rollups of the genres and years changed since the last run (or all of them with --full)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true', help="Rebuild every rollup row from scratch")
+
+    def handle(self, *args, **options):
+        if options['full']:
+            rebuild_stats()
+            self.stdout.write(self.style.SUCCESS("Stats rebuilt."))
+            return
+        marks = refresh_dirty()
+        self.stdout.write(self.style.SUCCESS(f"Stats refreshed ({marks} changes)."))
@@ -0,0 +1,96 @@
+import json
+import platform
+import subprocess
+import time
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import setup_databases, setup_test_environment, teardown_databases, teardown_test_environment
+from booksys.benchmarks import compare, load, run_suite
+from booksys.catalog import generate_catalog, parse_size
+
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmarks every booksys url against generated catalogs: for each size a fresh test database is created and filled by "
+        "generate_catalog, then latency, query count and peak memory of each request are reported (never touches the real database)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='1k', help="Comma separated catalog sizes (books), e.g. 1k,100k,1m")
+        parser.add_argument('--repeat', type=int, default=5, help="Timed runs per request")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--only', help="Only the cases whose name contains this, e.g. 'book-list'")
+        parser.add_argument('--cache', action='store_true', help="Keep the response cache on (measures cache hits)")
+        parser.add_argument('--test-db-file', help="SQLite file for the test database instead of memory (for the big sizes)")
+        parser.add_argument('--output', help="Write the results as JSON to this file")
+        parser.add_argument('--compare', help="A previous --output file to compare the p50 latencies with")
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [(size.strip(), parse_size(size)) for size in options['sizes'].split(',')]
+        except ValueError as error:
+            raise CommandError(str(error))
+        if options['repeat'] < 1:
+            raise CommandError("--repeat must be at least 1")
+        baseline = load(options['compare']) if options['compare'] else None
+        if options['test_db_file']:
+            connection.settings_dict.setdefault('TEST', {})['NAME'] = options['test_db_file']
+
+        report = {
+            'commit': _commit(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'repeat': options['repeat'],
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'runs': [],
+        }
+        setup_test_environment()
+        try:
+            with override_settings(BOOKSYS_RESPONSE_CACHE=options['cache']):
+                for label, books in sizes:
+                    report['runs'].append(self.run_size(label, books, options))
+        finally:
+            teardown_test_environment()
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                file.write(output)
+            self.stdout.write(self.style.SUCCESS(f"Results written to {options['output']}"))
+        else:
+            self.stdout.write(output)
+        if baseline is not None:
+            for line in compare(baseline, report):
+                self.stdout.write(line)
+
+    def run_size(self, label, books, options):
+        self.stderr.write(f"{label}: creating the test database and {books} books...")
+        old_config = setup_databases(verbosity=0, interactive=False, aliases={'default'})
+        try:
+            started = time.perf_counter()
+            rows = generate_catalog(books, seed=options['seed'])
+            generated = time.perf_counter() - started
+            self.stderr.write(f"{label}: generated in {generated:.1f}s, running the requests...")
+            results = run_suite(Client(), repeat=options['repeat'], only=options['only'])
+        finally:
+            teardown_databases(old_config, verbosity=0)
+        for result in results:
+            if 'skipped' in result:
+                self.stderr.write(f"  {result['name']:<28} skipped: {result['skipped']}")
+            else:
+                self.stderr.write(
+                    f"  {result['name']:<28} {result['status']} p50 {result['latency_ms']['p50']:>9.2f}ms  "
+                    f"{result['queries']:>3} queries  {result['peak_memory_kb']:>10.1f} KiB"
+                    + (f"  body {result['response_kb']:>9.1f} KiB" if result['response_kb'] is not None else "")
+                )
+        return {'size': label, 'books': books, 'rows': rows, 'generate_seconds': round(generated, 2), 'results': results}
@@ -0,0 +1,141 @@
+import logging
+import time
+from contextlib import ExitStack
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from . import instrumentation, routers
+
+logger = logging.getLogger('booksys.instrumentation')
+
+"""
+Both middlewares work in sync and async mode. Under ASGI a sync-only middleware makes Django run the rest of the chain,
+async views included, in a sync_to_async thread, which is what the async views (async_views.py) are there to avoid.
+In async mode their process_view/process_template_response are coroutines as well (_on_loop), plain methods would each
+be another trip to the thread pool; they only set a few attributes/context variables so they run on the event loop.
+"""
+
+
+def _on_loop(method):
+    async def hook(*args):
+        return method(*args)
+    return hook
+
+
+class AsyncCapableMiddleware:
+    sync_capable = True
+    async_capable = True
+    hooks = ()
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+            for name in self.hooks:
+                setattr(self, name, _on_loop(getattr(self, name)))
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.acall(request)
+        return self.call(request)
+
+
+class InstrumentationMiddleware(AsyncCapableMiddleware):
+    """
+    Records queries/db time/serializer time/render time of every booksys request (see instrumentation.py).
+    When BOOKSYS_INSTRUMENTATION is off Django drops the middleware at startup (MiddlewareNotUsed), so it costs nothing.
+    BOOKSYS_INSTRUMENTATION_HEADER adds an X-Booksys-Stats header to the response and BOOKSYS_INSTRUMENTATION_LOG logs a
+    line per request with the slowest statement.
+    """
+
+    hooks = ('process_view', 'process_template_response')
+
+    def __init__(self, get_response):
+        if not instrumentation.is_enabled():
+            raise MiddlewareNotUsed
+        super().__init__(get_response)
+
+    @staticmethod
+    def wrap_connections(stats):
+        stack = ExitStack()
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(stats.execute_wrapper))
+        return stack
+
+    def call(self, request):
+        stats = instrumentation.RequestStats()
+        token = instrumentation.activate(stats)
+        try:
+            with self.wrap_connections(stats):
+                response = self.get_response(request)
+        finally:
+            instrumentation.deactivate(token)
+        return self.finish(request, response, stats)
+
+    async def acall(self, request):
+        stats = instrumentation.RequestStats()
+        token = instrumentation.activate(stats)
+        try:
+            # the queries of an async view run in the request's thread_sensitive sync_to_async thread, which has its own
+            # connections: the wrappers go on those (and come off in the same thread)
+            stack = await sync_to_async(self.wrap_connections)(stats)
+            try:
+                response = await self.get_response(request)
+            finally:
+                await sync_to_async(stack.close)()
+        finally:
+            instrumentation.deactivate(token)
+        return self.finish(request, response, stats)
+
+    def finish(self, request, response, stats):
+        stats.finish()
+        if stats.view is None: # not a booksys view (admin, 404, ...)
+            return response
+        endpoint = f'{request.method} {stats.view}'
+        instrumentation.METRICS.record(endpoint, stats)
+        if getattr(settings, 'BOOKSYS_INSTRUMENTATION_HEADER', False):
+            response['X-Booksys-Stats'] = stats.header()
+        if getattr(settings, 'BOOKSYS_INSTRUMENTATION_LOG', False):
+            logger.info(
+                '%s %s %s queries=%d db=%.2fms serializer=%.2fms render=%.2fms total=%.2fms slowest=%.2fms %s',
+                request.method, request.path, stats.view, stats.queries, stats.db_time * 1000, stats.serializer_time * 1000,
+                stats.render_time * 1000, stats.total_time * 1000, stats.slowest_time * 1000, (stats.slowest_sql or '')[:500],
+            )
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        view_class = getattr(view_func, 'view_class', None)
+        if view_class is not None and view_class.__module__.startswith('booksys.'):
+            instrumentation.current_stats().view = view_class.__name__
+
+    def process_template_response(self, request, response):
+        # called right before Django renders the (DRF) response, the callback runs right after
+        stats = instrumentation.current_stats()
+        if stats is not None and not getattr(response, 'is_rendered', True):
+            started = time.perf_counter()
+            response.add_post_render_callback(lambda rendered: stats.add('render', time.perf_counter() - started))
+        return response
+
+
+class ReadRoutingMiddleware(AsyncCapableMiddleware):
+    """Marks the GET/HEAD requests of booksys views so their reads go to the read database (see routers.py)"""
+    hooks = ('process_view',)
+
+    def call(self, request):
+        try:
+            return self.get_response(request)
+        finally:
+            routers.set_reading(False)
+
+    async def acall(self, request):
+        try:
+            return await self.get_response(request)
+        finally:
+            routers.set_reading(False)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        view_class = getattr(view_func, 'view_class', None)
+        if request.method in ('GET', 'HEAD') and view_class is not None and view_class.__module__.startswith('booksys.'):
+            routers.set_reading(True)
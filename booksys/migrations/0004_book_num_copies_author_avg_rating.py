@@ -0,0 +1,55 @@
+# Generated by Django 5.1.15 on 2026-10-18 02:27
+
+from django.db import migrations, models
+from django.db.models import Avg, Count, IntegerField, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def fill_counters(apps, schema_editor):
+    Book = apps.get_model('booksys', 'Book')
+    Author = apps.get_model('booksys', 'Author')
+    Copy = apps.get_model('booksys', 'Copy')
+    BookAuthor = apps.get_model('booksys', 'BookAuthor')
+
+    def count_copies(**filters):
+        copies = Copy.objects.filter(book=OuterRef('pk'), **filters).order_by().values('book').annotate(count=Count('pk')).values('count')
+        return Coalesce(Subquery(copies, output_field=IntegerField()), Value(0))
+
+    Book.objects.update(
+        num_copies=count_copies(),
+        num_available=count_copies(lent=False),
+        num_lent=count_copies(lent=True),
+    )
+    ratings = BookAuthor.objects.filter(author=OuterRef('pk')).order_by().values('author').annotate(avg=Avg('book__rating')).values('avg')
+    Author.objects.update(avg_rating=Subquery(ratings))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booksys', '0003_alter_book_date_published'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='author',
+            name='avg_rating',
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='num_available',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='num_copies',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='num_lent',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 5.1.15 on 2026-10-18 02:29
+
+import django.db.models.deletion
+import django.db.models.functions.text
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booksys', '0004_book_num_copies_author_avg_rating'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='bookauthor',
+            name='author',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.RESTRICT, related_name='authored_books', to='booksys.author'),
+        ),
+        migrations.AlterField(
+            model_name='copy',
+            name='book',
+            field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='copies', to='booksys.book'),
+        ),
+        migrations.AddIndex(
+            model_name='author',
+            index=models.Index(django.db.models.functions.text.Lower('name'), name='booksys_author_name_lower_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(django.db.models.functions.text.Lower('title'), name='booksys_book_title_lower_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='bookauthor',
+            index=models.Index(fields=['author', 'role'], name='booksys_bookauthor_author_role'),
+        ),
+        migrations.AddIndex(
+            model_name='bookauthor',
+            index=models.Index(django.db.models.functions.text.Lower('role'), models.F('author'), name='booksys_bookauthor_role_lower'),
+        ),
+        migrations.AddIndex(
+            model_name='copy',
+            index=models.Index(fields=['book', 'lent'], name='booksys_copy_book_lent'),
+        ),
+        migrations.AddIndex(
+            model_name='genre',
+            index=models.Index(django.db.models.functions.text.Lower('name'), name='booksys_genre_name_lower_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+from django.db import migrations
+
+
+def install_fts(apps, schema_editor):
+    from booksys.search import install
+    install(schema_editor.connection)
+
+
+def uninstall_fts(apps, schema_editor):
+    from booksys.search import uninstall
+    uninstall(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+    """FTS5 tables + sync triggers for book and author search (a no-op on databases without FTS5, search falls back to icontains)"""
+
+    dependencies = [
+        ('booksys', '0005_case_folded_and_composite_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(install_fts, uninstall_fts),
+    ]
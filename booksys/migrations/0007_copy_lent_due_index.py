@@ -0,0 +1,17 @@
+# Generated by Django 5.1.15 on 2026-10-18 02:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booksys', '0006_full_text_search'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='copy',
+            index=models.Index(condition=models.Q(('lent', True)), fields=['return_date'], name='booksys_copy_lent_due'),
+        ),
+    ]
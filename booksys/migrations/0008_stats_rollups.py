@@ -0,0 +1,64 @@
+# Generated by Django 5.1.15 on 2026-10-18 02:50
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models.functions import ExtractYear
+
+
+def mark_everything_dirty(apps, schema_editor):
+    # the rollups of every genre and year are then computed by the first /stats/ request or refresh_stats run
+    Genre = apps.get_model('booksys', 'Genre')
+    Book = apps.get_model('booksys', 'Book')
+    StatsDirty = apps.get_model('booksys', 'StatsDirty')
+    years = Book.objects.annotate(year=ExtractYear('date_published')).values_list('year', flat=True).distinct()
+    StatsDirty.objects.bulk_create(
+        [StatsDirty(kind='genre', key=pk) for pk in Genre.objects.values_list('pk', flat=True)]
+        + [StatsDirty(kind='year', key=year) for year in years]
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booksys', '0007_copy_lent_due_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GenreStats',
+            fields=[
+                ('genre', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to='booksys.genre')),
+                ('num_books', models.PositiveIntegerField(default=0)),
+                ('rating_sum', models.FloatField(default=0)),
+                ('num_copies', models.PositiveIntegerField(default=0)),
+                ('num_lent', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='StatsDirty',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('genre', 'Genre'), ('year', 'Year'), ('book', 'Book')], max_length=5)),
+                ('key', models.BigIntegerField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='YearStats',
+            fields=[
+                ('year', models.IntegerField(primary_key=True, serialize=False)),
+                ('num_books', models.PositiveIntegerField(default=0)),
+                ('rating_sum', models.FloatField(default=0)),
+                ('num_copies', models.PositiveIntegerField(default=0)),
+                ('num_lent', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(fields=['date_published'], name='booksys_book_published'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='statsdirty',
+            unique_together={('kind', 'key')},
+        ),
+        migrations.RunPython(mark_everything_dirty, migrations.RunPython.noop),
+    ]
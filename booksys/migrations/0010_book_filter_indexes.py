@@ -0,0 +1,21 @@
+# Generated by Django 5.1.15 on 2026-10-18 03:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booksys', '0009_change_log'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(fields=['rating'], name='booksys_book_rating'),
+        ),
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(fields=['num_copies'], name='booksys_book_num_copies'),
+        ),
+    ]
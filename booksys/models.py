@@ -1,6 +1,12 @@
 from django.db import models
+from django.db.models import F
+from django.db.models.functions import Lower
 from django.core.validators import MinValueValidator, MaxValueValidator
 
+# lets the views filter with `name__lower=Lower(Value(x))` instead of `name__iexact=x`. On SQLite iexact is a LIKE ... ESCAPE
+# which never uses an index, while LOWER(name) = LOWER(x) can use the functional indexes declared below
+models.CharField.register_lookup(Lower)
+
 
 class Genre(models.Model):
     """ A model to represent the different generes a book can have"""
@@ -16,6 +22,11 @@ class Genre(models.Model):
 
     name = models.CharField(max_length=10, choices = Genre_Choices, null=False, unique = True) # can alternatively check for uniqueness in the serializer or the view
 
+    class Meta:
+        indexes = [
+            models.Index(Lower('name'), name='booksys_genre_name_lower_idx'),
+        ]
+
     def __str__(self):
         return f"{self.name}"
 
@@ -24,6 +35,13 @@ class Author(models.Model):
     name = models.CharField(max_length = 255, null=False, unique=True)
     introduction = models.TextField(null=True, blank=True)
     place_of_origin = models.TextField(null=True, blank=True)
+    # denormalized average of the ratings of the author's books, kept up to date by counters.py (null when there are no books)
+    avg_rating = models.FloatField(null=True, blank=True, editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(Lower('name'), name='booksys_author_name_lower_idx'),
+        ]
 
     def __str__(self):
         return f"{self.name}"
@@ -40,6 +58,19 @@ class Book(models.Model):
     # # the through here to allow adding extra fields to the M2M relationship
     genres = models.ManyToManyField(Genre, related_name='books')
     date_published = models.DateField()
+    # denormalized copy counts, kept up to date by counters.py instead of counting the copies on every request
+    num_copies = models.PositiveIntegerField(default=0, editable=False)
+    num_available = models.PositiveIntegerField(default=0, editable=False)
+    num_lent = models.PositiveIntegerField(default=0, editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(Lower('title'), name='booksys_book_title_lower_idx'),
+            models.Index(fields=['date_published'], name='booksys_book_published'), # per year stats, ordering by date
+            # ?rating__gte=/lte= and the ?ordering= allowlist (queries.py), title has its unique index
+            models.Index(fields=['rating'], name='booksys_book_rating'),
+            models.Index(fields=['num_copies'], name='booksys_book_num_copies'),
+        ]
     
     def __str__(self):
         return f"{self.title}; {self.rating} stars"
@@ -48,18 +79,91 @@ class Book(models.Model):
 class BookAuthor(models.Model):
     """A model to represent a M-M relationship between books and authors with added attributes (role)"""
     book = models.ForeignKey(Book, on_delete = models.CASCADE, related_name='book_authors') # you use book_authors when you're coming from books and want to reach this model
-    author = models.ForeignKey(Author, on_delete = models.RESTRICT, related_name='authored_books')
+    author = models.ForeignKey(Author, on_delete = models.RESTRICT, related_name='authored_books', db_index=False) # (author, role) index below covers it
     role = models.CharField(max_length=100)
 
     class Meta:
         unique_together = ['book', 'author'] # to avoid repetition
+        indexes = [
+            models.Index(fields=['author', 'role'], name='booksys_bookauthor_author_role'),
+            # for the role filter on the authors list, which starts from the role and then joins to the author
+            models.Index(Lower('role'), F('author'), name='booksys_bookauthor_role_lower'),
+        ]
 
     def __str__(self):
         return f"{self.author} => {self.book}"
 
 
 class Copy(models.Model):
-    book = models.ForeignKey(Book, on_delete = models.CASCADE, related_name = 'copies', null=True, blank=True)
+    book = models.ForeignKey(Book, on_delete = models.CASCADE, related_name = 'copies', null=True, blank=True, db_index=False) # (book, lent) index below covers it
     lent = models.BooleanField(default = False)
     lent_by = models.CharField(max_length = 255, default = None, null=True, blank=True) # ^^^ add the validation in the serializer where not null if lent: handle it in the serializer
     return_date = models.DateField(null=True,default = None, blank=True) # ^^^ same as lent by
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['book', 'lent'], name='booksys_copy_book_lent'), # the copies of a book that are (not) lent
+            # only lent copies have a return date, so the overdue/due soon ranges only need those rows
+            models.Index(fields=['return_date'], condition=models.Q(lent=True), name='booksys_copy_lent_due'),
+        ]
+
+
+"""
+Rollups for the /stats/ endpoint (stats.py). Sums instead of averages are stored so the totals and averages across rows
+can be derived exactly (avg = rating_sum / num_books). Rows are recomputed for the keys marked in StatsDirty.
+"""
+
+
+class GenreStats(models.Model):
+    genre = models.OneToOneField(Genre, on_delete=models.CASCADE, primary_key=True, related_name='stats')
+    num_books = models.PositiveIntegerField(default=0)
+    rating_sum = models.FloatField(default=0)
+    num_copies = models.PositiveIntegerField(default=0)
+    num_lent = models.PositiveIntegerField(default=0)
+
+
+class YearStats(models.Model):
+    year = models.IntegerField(primary_key=True)
+    num_books = models.PositiveIntegerField(default=0)
+    rating_sum = models.FloatField(default=0)
+    num_copies = models.PositiveIntegerField(default=0)
+    num_lent = models.PositiveIntegerField(default=0)
+
+
+class StatsDirty(models.Model):
+    """A genre, year or book whose rollups are out of date (a book stands for its genres and its year)"""
+    class Kind(models.TextChoices):
+        GENRE = 'genre'
+        YEAR = 'year'
+        BOOK = 'book'
+
+    kind = models.CharField(max_length=5, choices=Kind)
+    key = models.BigIntegerField()
+
+    class Meta:
+        unique_together = ['kind', 'key'] # marking the same key twice is a no-op (bulk_create(ignore_conflicts=True))
+
+
+class ChangeEvent(models.Model):
+    """One create/update/delete of a genre, author, book or copy, appended in the transaction of the write (changes.py)"""
+    class Kind(models.TextChoices):
+        GENRE = 'genre'
+        AUTHOR = 'author'
+        BOOK = 'book'
+        COPY = 'copy'
+
+    class Action(models.TextChoices):
+        UPSERT = 'upsert' # created or changed, the client reads the current state
+        DELETE = 'delete'
+
+    id = models.BigAutoField(primary_key=True) # the /changes/ cursor, only ever grows
+    kind = models.CharField(max_length=6, choices=Kind)
+    object_id = models.BigIntegerField()
+    action = models.CharField(max_length=6, choices=Action, default=Action.UPSERT)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # compaction looks for later events of the same object
+            models.Index(fields=['kind', 'object_id'], name='booksys_change_object'),
+        ]
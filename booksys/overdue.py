@@ -0,0 +1,94 @@
+import re
+from datetime import date, timedelta
+from django.db.models import Count, Min, Q
+from rest_framework.exceptions import ValidationError
+from .models import *
+
+"""
+Overdue and due soon copies. Both are a range over the return dates of lent copies, which is exactly what the partial index
+booksys_copy_lent_due (return_date WHERE lent) holds, so they are an index range scan instead of a scan of every copy.
+The groupings (per borrower, per book) are done by the db.
+"""
+
+WITHIN_UNITS = {'d': 1, 'w': 7}
+MAX_WITHIN_DAYS = 5 * 366 # a few years, a bigger ?within= is a typo (and past date.max it is an OverflowError)
+GROUPINGS = {
+    'lent_by': ['lent_by'],
+    'book': ['book', 'book__title'],
+}
+
+
+def parse_within(value):
+    """'7d', '2w' or a plain number of days"""
+    match = re.fullmatch(r'\s*(\d+)\s*([dw]?)\s*', value or '')
+    if not match:
+        raise ValidationError({'within': "Use a number of days or weeks, e.g. 7d or 2w."})
+    days = int(match.group(1)) * WITHIN_UNITS.get(match.group(2) or 'd')
+    if days > MAX_WITHIN_DAYS:
+        raise ValidationError({'within': f"Can be at most {MAX_WITHIN_DAYS} days."})
+    return timedelta(days=days)
+
+
+def parse_as_of(value):
+    if not value:
+        return date.today()
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise ValidationError({'as_of': "Must be a date (YYYY-MM-DD)."})
+
+
+def lent_copies(queryset=None):
+    # lent=True is the condition of the partial index, the db can only use the index when the query has it too
+    return (Copy.objects.all() if queryset is None else queryset).filter(lent=True)
+
+
+def overdue_copies(as_of, queryset=None):
+    return lent_copies(queryset).filter(return_date__lt=as_of)
+
+
+def due_copies(as_of, within, queryset=None):
+    try:
+        until = as_of + within
+    except OverflowError: # ?as_of= close to 9999-12-31
+        until = date.max
+    return lent_copies(queryset).filter(return_date__gte=as_of, return_date__lte=until)
+
+
+def group_copies(queryset, group_by):
+    """One row per borrower or per book: how many copies and the earliest return date, the biggest groups first"""
+    if group_by not in GROUPINGS:
+        raise ValidationError({'group_by': f"Can only group by one of: {', '.join(GROUPINGS)}."})
+    fields = GROUPINGS[group_by]
+    rows = (
+        queryset.order_by().values(*fields)
+        .annotate(count=Count('id'), earliest_return_date=Min('return_date'))
+        .order_by('-count', *fields)
+    )
+    if group_by == 'book':
+        return [
+            {'book': row['book'], 'title': row['book__title'], 'count': row['count'], 'earliest_return_date': row['earliest_return_date']}
+            for row in rows
+        ]
+    return list(rows)
+
+
+def iter_overdue(as_of, batch_size):
+    """
+    Every overdue copy in (return_date, id) order, read batch_size rows at a time.
+    Each batch seeks past the last row of the one before along the index instead of using OFFSET, so memory stays at one batch
+    and each batch costs the same no matter how far into the table it is.
+    """
+    queryset = overdue_copies(as_of).order_by('return_date', 'id').values('id', 'book_id', 'book__title', 'lent_by', 'return_date')
+    last = None
+    while True:
+        batch = queryset
+        if last is not None:
+            batch = batch.filter(Q(return_date__gt=last['return_date']) | Q(return_date=last['return_date'], id__gt=last['id']))
+        rows = list(batch[:batch_size])
+        if not rows:
+            return
+        yield rows
+        if len(rows) < batch_size: # a short batch is the last one
+            return
+        last = rows[-1]
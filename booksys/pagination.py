@@ -0,0 +1,135 @@
+import base64
+import json
+from django.conf import settings
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination:
+    """
+    Cursor pagination that seeks instead of using OFFSET: the cursor holds the (ordering value, pk) of the last row of a page
+    and the next page is `WHERE (field > value) OR (field = value AND id > pk) ORDER BY field, id LIMIT n`.
+    That way page 5000 costs the same as page 1 as long as (field, id) is indexed. The pk is used as a tie breaker so the
+    order is stable even when the ordering field has duplicates.
+
+    Only turned on when the client asks for it (`cursor` or `page_size` in the query params) so existing clients keep getting a plain list.
+    """
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    ordering_query_param = 'ordering'
+
+    def __init__(self, ordering_fields, default_ordering='id', list_ordering_fields=()):
+        # only non nullable fields can be used here, a NULL breaks the comparison in the seek predicate
+        self.ordering_fields = set(ordering_fields) | {'id'}
+        # the unpaginated list can also be ordered by these (e.g. a nullable column), the pages can't
+        self.list_ordering_fields = self.ordering_fields | set(list_ordering_fields)
+        self.default_ordering = default_ordering
+        self.page_size = getattr(settings, 'BOOKSYS_PAGE_SIZE', 50)
+        self.max_page_size = getattr(settings, 'BOOKSYS_MAX_PAGE_SIZE', 500)
+
+    def is_requested(self, request):
+        return self.cursor_query_param in request.query_params or self.page_size_query_param in request.query_params
+
+    def get_page_size(self, request):
+        page_size = request.query_params.get(self.page_size_query_param)
+        if page_size is None:
+            return self.page_size
+        try:
+            page_size = int(page_size)
+        except ValueError:
+            raise ValidationError({self.page_size_query_param: "Must be an integer."})
+        if page_size < 1:
+            raise ValidationError({self.page_size_query_param: "Must be at least 1."})
+        return min(page_size, self.max_page_size) # cap so a client can't ask for the whole table in one page
+
+    def get_ordering(self, request):
+        return self.requested_ordering(request, self.ordering_fields) or self.default_ordering
+
+    def requested_ordering(self, request, fields=None):
+        """The ?ordering= if one was given, also for the unpaginated lists: only the allowlisted fields, never any string"""
+        fields = self.list_ordering_fields if fields is None else fields
+        ordering = request.query_params.get(self.ordering_query_param)
+        if ordering and ordering.lstrip('-') not in fields:
+            raise ValidationError({self.ordering_query_param: f"Can only order by one of: {', '.join(sorted(fields))}."})
+        return ordering or None
+
+    def encode_cursor(self, ordering, value, pk):
+        payload = json.dumps([ordering, value, pk], cls=DjangoJSONEncoder)
+        return base64.urlsafe_b64encode(payload.encode()).decode()
+
+    def decode_cursor(self, cursor, ordering, field):
+        """(value, pk) of the cursor, the value as the python type of `field` (the model field it orders by)"""
+        try:
+            cursor_ordering, value, pk = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        except (TypeError, ValueError):
+            raise NotFound("Invalid cursor.")
+        if cursor_ordering != ordering: # a cursor only makes sense for the ordering it was created with
+            raise NotFound("Invalid cursor.")
+        # the client can send anything, a value the db can't compare with the column would be a 500 instead
+        try:
+            value = field.to_python(value)
+            pk = int(pk)
+        except (TypeError, ValueError, DjangoValidationError):
+            raise NotFound("Invalid cursor.")
+        if value is None: # the ordering fields are not nullable
+            raise NotFound("Invalid cursor.")
+        return value, pk
+
+    def page_queryset(self, queryset, request):
+        """The (lazy) queryset of the requested page, with one extra row to know if there is a next page without a COUNT"""
+        self.request = request
+        self.ordering = self.get_ordering(request)
+        self.current_page_size = self.get_page_size(request)
+        field = self.ordering.lstrip('-')
+        descending = self.ordering.startswith('-')
+        direction = 'lt' if descending else 'gt'
+
+        if field == 'id':
+            queryset = queryset.order_by(self.ordering)
+        else:
+            queryset = queryset.order_by(self.ordering, '-id' if descending else 'id')
+
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor:
+            value, pk = self.decode_cursor(cursor, self.ordering, queryset.model._meta.get_field(field))
+            if field == 'id':
+                queryset = queryset.filter(**{f'id__{direction}': pk})
+            else:
+                queryset = queryset.filter(
+                    Q(**{f'{field}__{direction}': value}) | Q(**{field: value, f'id__{direction}': pk})
+                )
+        return queryset[:self.current_page_size + 1]
+
+    def set_page(self, rows):
+        """Takes the rows of page_queryset() and returns the page"""
+        self.has_next = len(rows) > self.current_page_size
+        page = rows[:self.current_page_size]
+        if self.has_next:
+            last = page[-1]
+            field = self.ordering.lstrip('-')
+            if isinstance(last, dict): # values() rows (representations.py)
+                self.next_cursor = self.encode_cursor(self.ordering, last[field], last['id'])
+            else:
+                self.next_cursor = self.encode_cursor(self.ordering, getattr(last, field), last.pk)
+        else:
+            self.next_cursor = None
+        return page
+
+    def paginate_queryset(self, queryset, request):
+        return self.set_page(list(self.page_queryset(queryset, request)))
+
+    def get_next_link(self):
+        if self.next_cursor is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.next_cursor)
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'results': data,
+        })
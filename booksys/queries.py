@@ -0,0 +1,155 @@
+from datetime import date
+from django.db.models import Exists, OuterRef, Prefetch, Value
+from django.db.models.functions import Lower
+from rest_framework.exceptions import ValidationError
+from .models import *
+from .sparse import ALL_FIELDS
+from .genres import genre_ids_named
+
+"""
+Shared queryset builders for the views.
+Each one loads exactly the relations its serializer renders, so serializing a page costs a fixed number of queries
+(one for the rows + one per prefetched relation) instead of a few queries per row.
+With sparse fieldsets (see sparse.py) the relations and big text columns that are not rendered are left out as well.
+"""
+
+
+def book_queryset(sparse=ALL_FIELDS):
+    """Books with everything BookSerializer renders: authors (with the author row for the string), genres and copies"""
+    # num_copies is a stored column now (see counters.py) so there is no GROUP BY here
+    prefetches = []
+    if sparse.wants_any('authors_info', 'coauthors'):
+        # select_related so the StringRelatedField on author does not fetch each author separately
+        prefetches.append(Prefetch('book_authors', queryset=BookAuthor.objects.select_related('author')))
+    if sparse.wants('genres_info'):
+        prefetches.append('genres')
+    if sparse.wants('copies'):
+        prefetches.append('copies')
+    books = Book.objects.prefetch_related(*prefetches)
+    if not sparse.wants('blurb'):
+        books = books.defer('blurb')
+    return books
+
+
+def author_queryset(sparse=ALL_FIELDS):
+    """Authors with the books AuthorSerializer renders (avg_rating is a stored column)"""
+    authors = Author.objects.all()
+    if sparse.wants('authored_books'):
+        authors = authors.prefetch_related(Prefetch('authored_books', queryset=BookAuthor.objects.select_related('book')))
+    deferred = [name for name in ('introduction', 'place_of_origin') if not sparse.wants(name)]
+    if deferred:
+        authors = authors.defer(*deferred)
+    return authors
+
+
+def copy_queryset(sparse=ALL_FIELDS):
+    """Copies with their book (and the book's genres) for the book_info in CopySerializer"""
+    if not sparse.wants('book_info'):
+        return Copy.objects.all()
+    return Copy.objects.select_related('book').prefetch_related('book__genres')
+
+
+"""
+The ?filters of the list views, shared by the sync (views.py) and async (async_views.py) views.
+A genre name is turned into genre IDs with the in-process genre table (genres.py) so the filter is a genre_id IN (...) on the
+link table, without joining the genre table. When the table is not available the name is compared as before.
+
+The book list filters:
+    ?rating__gte= ?rating__lte= ?date_published__gte= ?date_published__lte=   ranges on indexed columns
+    ?genres=a or ?genres__in=a,b (any of them) and ?genres__all=a,b (every one of them)
+    ?book_authors=x&book_authors=y (repeatable, names can have commas) and ?role=writer (repeatable)
+All of them are ANDed. The multi-valued ones are EXISTS (...) on the link tables (one per ?genres__all= name) instead of
+joins, so a book that matches several links is not repeated and no DISTINCT is needed: the outer query can still be read
+in index order and the keyset pagination seeks as before. ?ordering= only takes BOOK_ORDERING_FIELDS (all indexed), the views
+check it with KeysetPagination.requested_ordering on every branch.
+"""
+
+BOOK_ORDERING_FIELDS = ['title', 'rating', 'date_published', 'num_copies']
+AUTHOR_LIST_ORDERING_FIELDS = ['avg_rating'] # nullable, so only for the unpaginated author list (besides the name of the pages)
+
+
+def _genre_filter(path, name):
+    ids = genre_ids_named(name)
+    if ids is None:
+        return {f'{path}__name__lower': Lower(Value(name))}
+    return {f'{path}__in': ids}
+
+
+def _names(params, key):
+    # ?genres__in=a,b and ?genres__in=a&genres__in=b
+    return [name.strip() for value in params.getlist(key) for name in value.split(',') if name.strip()]
+
+
+def _has_genre(names):
+    """EXISTS (a link of the book in the outer query to one of the genres called `names`, any case)"""
+    links = Book.genres.through.objects.filter(book_id=OuterRef('pk'))
+    ids = [genre_ids_named(name) for name in names]
+    if None in ids:
+        return Exists(links.filter(genre__in=Genre.objects.filter(name__lower__in=[Lower(Value(name)) for name in names]).values('pk')))
+    return Exists(links.filter(genre_id__in=[pk for pks in ids for pk in pks]))
+
+
+def _has_author(names, roles):
+    """EXISTS (an author link of the book with one of the author `names` and one of the `roles`, any case)"""
+    links = BookAuthor.objects.filter(book_id=OuterRef('pk'))
+    if names:
+        # the authors first, with the LOWER(name) index, instead of joining the author table per link
+        links = links.filter(author__in=Author.objects.filter(name__lower__in=[Lower(Value(name)) for name in names]).values('pk'))
+    if roles:
+        links = links.filter(role__lower__in=[Lower(Value(role)) for role in roles])
+    return Exists(links)
+
+
+def _parse(params, key, parse, message):
+    value = params.get(key)
+    if not value:
+        return None
+    try:
+        return parse(value)
+    except ValueError:
+        raise ValidationError({key: message})
+
+
+def filter_books(books, params):
+    for lookup in ('gte', 'lte'):
+        rating = _parse(params, f'rating__{lookup}', float, "Must be a number.")
+        if rating is not None:
+            books = books.filter(**{f'rating__{lookup}': rating})
+        published = _parse(params, f'date_published__{lookup}', date.fromisoformat, "Must be a date (YYYY-MM-DD).")
+        if published is not None:
+            books = books.filter(**{f'date_published__{lookup}': published})
+
+    any_genres = _names(params, 'genres') + _names(params, 'genres__in')
+    if any_genres:
+        books = books.filter(_has_genre(any_genres))
+    for name in _names(params, 'genres__all'):
+        books = books.filter(_has_genre([name]))
+
+    author_names = [name for name in params.getlist('book_authors') if name]
+    roles = [role for role in params.getlist('role') if role]
+    if author_names or roles:
+        books = books.filter(_has_author(author_names, roles))
+    return books
+
+
+def filter_authors(authors, params):
+    role = params.get('role')
+    if role:
+        authors = authors.filter(authored_books__role__lower=Lower(Value(role))).distinct()
+    return authors
+
+
+def filter_copies(copies, params):
+    book = params.get('book')
+    genre = params.get('genre')
+    lent = params.get('lent')
+    if book:
+        copies = copies.filter(book__title__lower=Lower(Value(book))).distinct()
+    if genre:
+        copies = copies.filter(**_genre_filter('book__genres', genre)).distinct()
+    if lent:
+        if lent.lower() == 'true':
+            copies = copies.filter(lent=True)
+        elif lent.lower() == 'false':
+            copies = copies.filter(lent=False)
+    return copies
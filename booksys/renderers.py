@@ -0,0 +1,136 @@
+from collections import defaultdict
+from datetime import date
+from rest_framework.exceptions import ValidationError
+from rest_framework.renderers import BaseRenderer
+from rest_framework.response import Response
+from .models import *
+from .genres import GENRES
+
+try:
+    import msgpack
+except ImportError: # optional, without it the views simply don't offer application/msgpack
+    msgpack = None
+
+try:
+    import pyarrow
+except ImportError: # optional as well
+    pyarrow = None
+
+"""
+Compact formats for bulk reads of the book and copy lists, picked by content negotiation (Accept header or ?format=):
+    application/msgpack                    {"columns": [...], "rows": [[...], ...]}
+    application/vnd.apache.arrow.stream    an Arrow IPC stream, one column per field
+Both are built straight from values_list() tuples, no model instances and no serializers, so most of the cost of the JSON
+path (instantiating objects, to_representation per field, encoding) is gone, and the client does not have to parse JSON either.
+The columns are flat (the ids and counters of the row, a book's genre names as one list column), filters and ?ordering= apply,
+pagination, ?fields= and ?expand= do not, and ?q=/?stream= are refused.
+msgpack and pyarrow are optional, a format is only offered when its package is installed.
+"""
+
+
+class Table:
+    """The rows of a columnar response, `columns` is a list of (name, arrow type name)"""
+    def __init__(self, columns, rows):
+        self.columns = columns
+        self.rows = rows
+
+    @property
+    def names(self):
+        return [name for name, _ in self.columns]
+
+
+BOOK_COLUMNS = [
+    ('id', 'int64'), ('title', 'string'), ('blurb', 'string'), ('rating', 'float64'), ('date_published', 'date32'),
+    ('num_copies', 'int64'), ('num_available', 'int64'), ('num_lent', 'int64'),
+]
+COPY_COLUMNS = [
+    ('id', 'int64'), ('book_id', 'int64'), ('book__title', 'string'), ('lent', 'bool_'), ('lent_by', 'string'), ('return_date', 'date32'),
+]
+
+
+def book_table(books):
+    columns = BOOK_COLUMNS + [('genres', 'list<string>')]
+    rows = list(books.values_list(*[name for name, _ in BOOK_COLUMNS]))
+    # the genre names of all the books in one query, instead of a prefetch that builds Genre objects
+    genres = defaultdict(list)
+    links = Book.genres.through.objects.filter(book_id__in=books.order_by().values('pk'))
+    table = GENRES.table()
+    if table is None:
+        for book_id, name in links.values_list('book_id', 'genre__name'):
+            genres[book_id].append(name)
+    else: # names from the genre table in memory, no join
+        for book_id, genre_id in links.values_list('book_id', 'genre_id'):
+            genres[book_id].append(table.name(genre_id))
+    return Table(columns, [row + (sorted(genres[row[0]]),) for row in rows])
+
+
+def copy_table(copies):
+    return Table(COPY_COLUMNS, list(copies.values_list(*[name for name, _ in COPY_COLUMNS])))
+
+
+def available_renderers():
+    """The columnar renderers whose package is installed"""
+    return [renderer for renderer, module in ((MessagePackRenderer, msgpack), (ArrowStreamRenderer, pyarrow)) if module is not None]
+
+
+def is_columnar_requested(request):
+    return getattr(getattr(request, 'accepted_renderer', None), 'columnar', False)
+
+
+def columnar_response(request, queryset, build_table, ordering=None):
+    """The response for the list views when a columnar format was negotiated, `ordering` is the view's checked ?ordering="""
+    for param in ('q', 'stream'):
+        if param in request.query_params:
+            raise ValidationError({param: "Not available with the columnar formats, use JSON."})
+    return Response(build_table(queryset.order_by(ordering or 'id')))
+
+
+def _msgpack_default(value):
+    if isinstance(value, date):
+        return value.isoformat() # msgpack only has a timestamp type for datetimes
+    raise TypeError(f"Cannot serialize {type(value).__name__} to msgpack")
+
+
+class MessagePackRenderer(BaseRenderer):
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+    columnar = True
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if isinstance(data, Table):
+            data = {'columns': data.names, 'rows': data.rows}
+        return msgpack.packb(data, default=_msgpack_default)
+
+
+def _arrow_type(name):
+    if name == 'list<string>':
+        return pyarrow.list_(pyarrow.string())
+    return getattr(pyarrow, name)()
+
+
+class ArrowStreamRenderer(BaseRenderer):
+    media_type = 'application/vnd.apache.arrow.stream'
+    format = 'arrow'
+    charset = None
+    render_style = 'binary'
+    columnar = True
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if isinstance(data, Table):
+            schema = pyarrow.schema([(name, _arrow_type(kind)) for name, kind in data.columns])
+            # rows -> columns, each column becomes one contiguous Arrow array
+            columns = list(zip(*data.rows)) or [[] for _ in data.columns]
+            table = pyarrow.Table.from_arrays([pyarrow.array(column, type=field.type) for column, field in zip(columns, schema)], schema=schema)
+        else: # errors ({"detail": ...}, validation errors): one row with the messages as strings
+            data = data if isinstance(data, dict) else {'detail': data}
+            table = pyarrow.Table.from_pylist([{str(key): str(value) for key, value in data.items()}])
+        sink = pyarrow.BufferOutputStream()
+        with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue().to_pybytes()
@@ -0,0 +1,187 @@
+from collections import defaultdict
+from django.conf import settings
+from .models import *
+from .sparse import ALL_FIELDS
+from .instrumentation import measure
+from .genres import GENRES
+
+"""
+A read only way to build the list output of GenreSerializer, AuthorSerializer, BookSerializer and CopySerializer straight
+from values() rows plus one values_list() per rendered relation, grouped by the parent id in Python. No model instances and
+no field by field to_representation, which is where most of the time of a big list went.
+The relation lookups have the same shape as the prefetches in queries.py (same tables, joins and filter), so the database
+returns their rows in the same order as it does for the serializers. The output has to stay byte for byte the same as the
+serializers', ContractTest in tests.py compares the two, so a field added to a serializer has to be added here too.
+Used by the list views unless their `values_path` is False or BOOKSYS_VALUES_PATH is off.
+"""
+
+
+def is_enabled(view):
+    return getattr(view, 'values_path', False) and getattr(settings, 'BOOKSYS_VALUES_PATH', True)
+
+
+def _date(value):
+    # DateField.to_representation
+    return value.isoformat() if value is not None else None
+
+
+def _float(value):
+    return float(value) if value is not None else None
+
+
+def _book_str(title, rating):
+    # Book.__str__ (the StringRelatedField on BookAuthor.book)
+    return f"{title}; {rating} stars"
+
+
+def genre_names(book_ids):
+    """{book id: [genre names]} like the 'genres' prefetch, the names come from the genre table in memory (genres.py)"""
+    names = defaultdict(list)
+    if not book_ids:
+        return names
+    table = GENRES.table()
+    if table is None:
+        for book_id, name in Genre.objects.filter(books__in=book_ids).values_list('books', 'name'):
+            names[book_id].append(name)
+        return names
+    for book_id, genre_id in Book.genres.through.objects.filter(book_id__in=book_ids).values_list('book_id', 'genre_id'):
+        names[book_id].append(table.name(genre_id))
+    return names
+
+
+class ValuesRepresentation:
+    """
+    `columns` are read with values() and must cover the keyset pagination orderings of the view (the cursor is read from
+    the row), `fields` are the readable fields of the serializer in its order, rendered by `represent()`.
+    """
+    columns = ['id']
+    fields = []
+
+    def __init__(self, sparse=ALL_FIELDS):
+        self.sparse = sparse
+
+    def wants(self, name):
+        return self.sparse.wants(name)
+
+    def wants_any(self, *names):
+        return self.sparse.wants_any(*names)
+
+    def get_columns(self):
+        return self.columns
+
+    def values(self, queryset):
+        return queryset.values(*self.get_columns())
+
+    def related(self, rows):
+        """Loads the relations the rows need, returns what represent() gets as `related`"""
+        return {}
+
+    def represent(self, row, related):
+        raise NotImplementedError
+
+    def data(self, rows):
+        """The list of dicts the serializer would give for these rows"""
+        rows = list(rows)
+        with measure('serializer'):
+            related = self.related(rows)
+            wanted = [name for name in self.fields if self.wants(name)]
+            return [{name: value for name, value in self.represent(row, related).items() if name in wanted} for row in rows]
+
+
+class GenreValues(ValuesRepresentation):
+    columns = ['id', 'name']
+    fields = ['name']
+
+    def represent(self, row, related):
+        return {'name': row['name']}
+
+
+class AuthorValues(ValuesRepresentation):
+    columns = ['id', 'name', 'avg_rating']
+    fields = ['id', 'name', 'introduction', 'place_of_origin', 'authored_books', 'avg_rating']
+
+    def get_columns(self):
+        return self.columns + [name for name in ('introduction', 'place_of_origin') if self.wants(name)]
+
+    def related(self, rows):
+        books = defaultdict(list)
+        if self.wants('authored_books') and rows:
+            links = BookAuthor.objects.filter(author_id__in=[row['id'] for row in rows])
+            for author_id, title, rating, role in links.values_list('author_id', 'book__title', 'book__rating', 'role'):
+                books[author_id].append({'book': _book_str(title, rating), 'role': role})
+        return {'books': books}
+
+    def represent(self, row, related):
+        return {
+            'id': row['id'],
+            'name': row['name'],
+            'introduction': row.get('introduction'),
+            'place_of_origin': row.get('place_of_origin'),
+            'authored_books': related['books'][row['id']],
+            'avg_rating': round(row['avg_rating'], 2) if row['avg_rating'] is not None else None, # get_avg_rating
+        }
+
+
+class BookValues(ValuesRepresentation):
+    columns = ['id', 'title', 'rating', 'date_published', 'num_copies', 'num_available', 'num_lent']
+    fields = [
+        'id', 'title', 'blurb', 'rating', 'genres_info', 'date_published', 'coauthors', 'authors_info', 'copies',
+        'num_copies', 'num_available', 'num_lent',
+    ]
+
+    def get_columns(self):
+        return self.columns + (['blurb'] if self.wants('blurb') else [])
+
+    def related(self, rows):
+        ids = [row['id'] for row in rows]
+        authors, copies = defaultdict(list), defaultdict(list)
+        if self.wants_any('authors_info', 'coauthors') and ids:
+            for book_id, name, role in BookAuthor.objects.filter(book_id__in=ids).values_list('book_id', 'author__name', 'role'):
+                authors[book_id].append({'author': name, 'role': role})
+        if self.wants('copies') and ids:
+            for book_id, lent, lent_by, return_date in Copy.objects.filter(book__in=ids).values_list('book_id', 'lent', 'lent_by', 'return_date'):
+                copies[book_id].append({'lent': lent, 'lent_by': lent_by, 'return_date': _date(return_date)})
+        genres = genre_names(ids) if self.wants('genres_info') else {}
+        return {'authors': authors, 'copies': copies, 'genres': genres}
+
+    def represent(self, row, related):
+        authors = related['authors'][row['id']]
+        return {
+            'id': row['id'],
+            'title': row['title'],
+            'blurb': row.get('blurb'),
+            'rating': _float(row['rating']),
+            'genres_info': related['genres'].get(row['id'], []),
+            'date_published': _date(row['date_published']),
+            'coauthors': len(authors) > 1,
+            'authors_info': authors,
+            'copies': related['copies'][row['id']],
+            'num_copies': row['num_copies'],
+            'num_available': row['num_available'],
+            'num_lent': row['num_lent'],
+        }
+
+
+class CopyValues(ValuesRepresentation):
+    columns = ['id', 'book_id', 'lent', 'lent_by', 'return_date']
+    fields = ['book_info', 'lent', 'lent_by', 'return_date']
+
+    def get_columns(self):
+        return self.columns + (['book__title', 'book__rating'] if self.wants('book_info') else [])
+
+    def related(self, rows):
+        if not self.wants('book_info'):
+            return {'genres': {}}
+        return {'genres': genre_names(list({row['book_id'] for row in rows if row['book_id'] is not None}))}
+
+    def represent(self, row, related):
+        book_info = None
+        if self.wants('book_info') and row['book_id'] is not None:
+            # BookMiniSerializer
+            book_info = {'title': row['book__title'], 'genres': related['genres'].get(row['book_id'], []), 'rating': _float(row['book__rating'])}
+        return {
+            'book_info': book_info,
+            'lent': row['lent'],
+            'lent_by': row['lent_by'],
+            'return_date': _date(row['return_date']),
+        }
@@ -0,0 +1,69 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from django.conf import settings
+
+"""
+Read/write splitting for booksys. Reads made while serving a GET request of a booksys view (ReadRoutingMiddleware in
+middleware.py marks those) go to the BOOKSYS_READ_DATABASE alias, everything else (writes, and the reads of a POST/PUT/...
+request, so they see the request's own writes) goes to the primary. When the read alias is not configured in
+DATABASES everything goes to the primary, so a single database setup needs nothing.
+"""
+
+_reading = ContextVar('booksys_reading', default=False)
+PRIMARY = 'default'
+
+
+def read_alias():
+    alias = getattr(settings, 'BOOKSYS_READ_DATABASE', None)
+    return alias if alias in settings.DATABASES else None
+
+
+def set_reading(value):
+    # a plain set (no token to reset): under ASGI the middleware hooks of one request can run in different copies of the context
+    _reading.set(value)
+
+
+@contextmanager
+def read_only():
+    """Routes the booksys reads made inside the block to the read alias (outside of a request, e.g. a report command)"""
+    token = _reading.set(True)
+    try:
+        yield
+    finally:
+        _reading.reset(token)
+
+
+@contextmanager
+def primary():
+    """Routes the booksys reads made inside the block to the primary, for writes that depend on what they read (even in a GET)"""
+    token = _reading.set(False)
+    try:
+        yield
+    finally:
+        _reading.reset(token)
+
+
+class ReadReplicaRouter:
+    route_app_labels = {'booksys'}
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label in self.route_app_labels and _reading.get():
+            return read_alias() or PRIMARY
+        return None
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label in self.route_app_labels:
+            return PRIMARY
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the replica holds the same rows as the primary
+        databases = {PRIMARY, read_alias()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if app_label in self.route_app_labels and db == read_alias():
+            return False # replicated from the primary, never migrated on its own
+        return None
@@ -0,0 +1,170 @@
+import re
+from django.db import connections
+from django.db.models import FloatField, Q
+from rest_framework.exceptions import ValidationError
+from .models import *
+from .pagination import KeysetPagination
+
+"""
+Full text search (?q=) over book titles/blurbs and author names/introductions.
+On SQLite the text is indexed in FTS5 virtual tables that use the real tables as external content and are kept in sync by
+triggers, so there is nothing to maintain in Python. Results are ranked with bm25 (matches in the title/name count more) and
+paginated with a (score, id) seek like the other lists. Other databases (or an SQLite built without FTS5) fall back to
+icontains filters ordered by id.
+"""
+
+
+class FullTextIndex:
+    def __init__(self, model, columns, weights):
+        self.model = model
+        self.columns = columns
+        self.weights = weights
+
+    @property
+    def table(self):
+        return f'{self.model._meta.db_table}_fts'
+
+    def install_sql(self):
+        """Idempotent DDL for the FTS table and the triggers that keep it in sync with the model's table"""
+        source = self.model._meta.db_table
+        columns = ', '.join(self.columns)
+        new_values = ', '.join(f'new.{column}' for column in self.columns)
+        old_values = ', '.join(f'old.{column}' for column in self.columns)
+        delete_old = f"INSERT INTO {self.table}({self.table}, rowid, {columns}) VALUES ('delete', old.id, {old_values});"
+        insert_new = f"INSERT INTO {self.table}(rowid, {columns}) VALUES (new.id, {new_values});"
+        return [
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {self.table} USING fts5({columns}, content='{source}', content_rowid='id')",
+            f"CREATE TRIGGER IF NOT EXISTS {self.table}_ai AFTER INSERT ON {source} BEGIN {insert_new} END",
+            f"CREATE TRIGGER IF NOT EXISTS {self.table}_ad AFTER DELETE ON {source} BEGIN {delete_old} END",
+            # only when the indexed columns are written, the counter updates do not touch the index
+            f"CREATE TRIGGER IF NOT EXISTS {self.table}_au AFTER UPDATE OF {columns} ON {source} BEGIN {delete_old} {insert_new} END",
+        ]
+
+    def uninstall_sql(self):
+        return [f"DROP TRIGGER IF EXISTS {name}" for name in sorted(self.trigger_names())] + [f"DROP TABLE IF EXISTS {self.table}"]
+
+    def trigger_names(self):
+        return {f'{self.table}_ai', f'{self.table}_ad', f'{self.table}_au'}
+
+    def rebuild_sql(self):
+        return f"INSERT INTO {self.table}({self.table}) VALUES ('rebuild')"
+
+
+BOOK_INDEX = FullTextIndex(Book, ['title', 'blurb'], weights=[10.0, 1.0])
+AUTHOR_INDEX = FullTextIndex(Author, ['name', 'introduction'], weights=[10.0, 1.0])
+INDEXES = [BOOK_INDEX, AUTHOR_INDEX]
+
+
+_supported = {} # per database alias, checked once
+
+
+def fts_supported(conn):
+    if conn.alias not in _supported:
+        if conn.vendor != 'sqlite':
+            _supported[conn.alias] = False
+        else:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+                _supported[conn.alias] = bool(cursor.fetchone()[0])
+    return _supported[conn.alias]
+
+
+def install(conn):
+    """
+    Creates the FTS tables and triggers where they are missing and reindexes them. Run by the migration and again after every
+    migrate: SQLite migrations that rebuild a table (e.g. adding a NOT NULL column) drop the triggers with the old table.
+    """
+    if not fts_supported(conn):
+        return
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'")
+        existing = {row[0] for row in cursor.fetchall()}
+        for index in INDEXES:
+            if index.trigger_names() <= existing:
+                continue
+            for statement in index.install_sql():
+                cursor.execute(statement)
+            cursor.execute(index.rebuild_sql()) # rows written while the triggers were missing
+
+
+def uninstall(conn):
+    if conn.vendor != 'sqlite':
+        return
+    with conn.cursor() as cursor:
+        for index in INDEXES:
+            for statement in index.uninstall_sql():
+                cursor.execute(statement)
+
+
+def match_expression(text):
+    """Turns user input into a safe FTS5 query: every word must match, the last one as a prefix (search as you type)"""
+    words = re.findall(r'\w+', text)
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+
+def _fallback_queryset(index, queryset, text):
+    words = re.findall(r'\w+', text)
+    condition = Q()
+    for word in words:
+        matches_word = Q()
+        for column in index.columns:
+            matches_word |= Q(**{f'{column}__icontains': word})
+        condition &= matches_word
+    return queryset.filter(condition)
+
+
+def search_response(request, index, queryset, serializer_class, context=None):
+    """
+    A ranked, paginated page of search results: {"next": url, "results": [...]}.
+    `queryset` is the view's (filtered) queryset, only matching rows that are also in it are returned.
+    """
+    text = request.query_params.get('q', '')
+    if 'ordering' in request.query_params:
+        raise ValidationError({'ordering': "Search results are ordered by relevance."})
+    paginator = KeysetPagination(ordering_fields=[])
+    page_size = paginator.get_page_size(request)
+    paginator.request = request
+    paginator.next_cursor = None
+    connection = connections[queryset.db] # where the router sends the view's reads, the in_bulk() below reads there too
+
+    if not fts_supported(connection):
+        # same cursor format as the plain lists, ordered by id
+        page = paginator.paginate_queryset(_fallback_queryset(index, queryset, text), request)
+        return paginator.get_paginated_response(serializer_class(page, many=True, context=context).data)
+
+    expression = match_expression(text)
+    if expression is None:
+        return paginator.get_paginated_response([])
+
+    weights = ', '.join(str(weight) for weight in index.weights)
+    score = f'bm25({index.table}, {weights})'
+    sql = f"SELECT rowid, {score} FROM {index.table} WHERE {index.table} MATCH %s"
+    params = [expression]
+    if queryset.query.where: # the view filtered the list, keep only matches it would show
+        ids_sql, ids_params = queryset.order_by().values('pk').query.get_compiler(connection=connection).as_sql()
+        sql += f" AND rowid IN ({ids_sql})"
+        params += ids_params
+
+    ordering = f'search:{text}' # a cursor is only valid for the query it came from
+    cursor_token = request.query_params.get(paginator.cursor_query_param)
+    if cursor_token:
+        last_score, last_id = paginator.decode_cursor(cursor_token, ordering, FloatField())
+        sql += f" AND ({score} > %s OR ({score} = %s AND rowid > %s))"
+        params += [last_score, last_score, last_id]
+    sql += f" ORDER BY {score}, rowid LIMIT %s"
+    params.append(page_size + 1)
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        paginator.next_cursor = paginator.encode_cursor(ordering, rows[-1][1], rows[-1][0])
+
+    objects = queryset.in_bulk([pk for pk, _ in rows])
+    page = [objects[pk] for pk, _ in rows if pk in objects]
+    return paginator.get_paginated_response(serializer_class(page, many=True, context=context).data)
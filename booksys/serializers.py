@@ -1,5 +1,11 @@
 from rest_framework import serializers
+from django.db import transaction
 from .models import *
+from .lookups import LookupCache
+from .genres import GENRES
+from .bulk import sync_book_authors
+from .instrumentation import current_stats
+import time
 from copy import deepcopy
 
 # ask for opinoin/ what tp add
@@ -10,6 +16,42 @@ from copy import deepcopy
 """Note: Apparently nesting serializers instead of flattening data is better in terms of intergration with frontend"""
 
 
+def _is_top_level(serializer):
+    # a list serializer's child counts as top level, the serializers nested in it don't
+    parent = serializer.parent.parent if isinstance(serializer.parent, serializers.ListSerializer) else serializer.parent
+    return parent is None
+
+
+class SparseFieldsMixin:
+    """Leaves out the read fields the request did not ask for (context['sparse_fields'], see sparse.py), only at the top level"""
+    def get_fields(self):
+        fields = super().get_fields()
+        sparse = self.context.get('sparse_fields')
+        if sparse is None or not _is_top_level(self):
+            return fields
+        return {name: field for name, field in fields.items() if field.write_only or sparse.wants(name)}
+
+
+class TimedSerializerMixin:
+    """Adds the time spent in to_representation to the request's 'serializer' timing (instrumentation.py)"""
+    def to_representation(self, instance):
+        stats = current_stats()
+        if stats is None or not _is_top_level(self): # not instrumented (the usual case) or a nested serializer, timed by its parent
+            return super().to_representation(instance)
+        started = time.perf_counter()
+        try:
+            return super().to_representation(instance)
+        finally:
+            stats.add('serializer', time.perf_counter() - started)
+
+
+class AtomicSaveMixin:
+    """Runs save() in a transaction so the object, its links and the counters updated by the signals are written together"""
+    def save(self, **kwargs):
+        with transaction.atomic():
+            return super().save(**kwargs)
+
+
 class AuthorLookupField(serializers.RelatedField):
     """This allows us to look up an author by their ID, Name or Create a new author in case they do not exist.
     We need this to avoid having to input the whole author object when trying to link an author to a book"""
@@ -18,26 +60,28 @@ class AuthorLookupField(serializers.RelatedField):
         super().__init__(**kwargs)
 
     def to_internal_value(self, data):
+        cache = LookupCache.for_field(self) # shared by every lookup field of the request
         if isinstance(data, int):
-            try:
-                return Author.objects.get(pk=data)
-            except Author.DoesNotExist:
+            author = cache.get(Author, data)
+            if author is None:
                 raise serializers.ValidationError("No author exists with this ID")
+            return author
         elif isinstance(data, str):
-            try:
-                return Author.objects.get(name=data)
-            except Author.DoesNotExist:
+            author = cache.get(Author, data)
+            if author is None:
                 raise serializers.ValidationError("No author exists with this name")
+            return author
         elif isinstance(data, dict):
             name = data.get("name")
             if not name:
                 raise serializers.ValidationError("Author name is required when creating an author")
-            try:
-                return Author.objects.get(name=name)
-            except Author.DoesNotExist:
-                serializer = AuthorSerializer(data=data)
+            author = cache.get(Author, name)
+            if author is None:
+                serializer = AuthorSerializer(data=data, context=self.root.context)
                 serializer.is_valid(raise_exception=True)
-                return serializer.save()
+                author = serializer.save()
+                cache.add(author) # so the next reference to this name in the payload does not create it again
+            return author
         else:
             raise serializers.ValidationError("Author must be an ID (int), name (str) or object (dict).")
         
@@ -50,31 +94,33 @@ class BookLookupField(serializers.RelatedField):
         super().__init__(**kwargs)
 
     def to_internal_value(self, data):
+        cache = LookupCache.for_field(self)
         if isinstance(data, int):
-            try:
-                return Book.objects.get(pk=data)
-            except Book.DoesNotExist:
+            book = cache.get(Book, data)
+            if book is None:
                 raise serializers.ValidationError("No book exists with this ID")
+            return book
         elif isinstance(data, str):
-            try:
-                return Book.objects.get(title=data)
-            except Book.DoesNotExist:
+            book = cache.get(Book, data)
+            if book is None:
                 raise serializers.ValidationError("No Book exists with this title")
+            return book
         elif isinstance(data, dict):
             title = data.get("title")
             if not title:
                 raise serializers.ValidationError("Book title is required when creating an book")
 
-            try:
-                return Book.objects.get(title=title)
-            except Book.DoesNotExist:
-                serializer_context = self.root.context.copy() # context stuff if nesting inside author
+            book = cache.get(Book, title)
+            if book is None:
+                serializer_context = self.root.context.copy() # context stuff if nesting inside author (the copy still shares the lookup cache)
                 # serializer_context['nested_in_author'] = True     # wrong to put this here
                 """We pass the context to the BookSerializer so that we do not require the authors of a book when its being created inside of 
                 an author [The author is implicit in this case]."""
                 serializer = BookSerializer(data=data, context=serializer_context)
                 serializer.is_valid(raise_exception=True)
-                return serializer.save()
+                book = serializer.save()
+                cache.add(book)
+            return book
         else:
             raise serializers.ValidationError("Book must be an ID (int), name (str) or object (dict).")
         
@@ -88,32 +134,39 @@ class GenreLookupField(serializers.RelatedField):
         super().__init__(**kwargs)
 
     def to_internal_value(self, data):
+        table = GENRES.table() # the genres in memory (genres.py), no query at all
+        if table is not None and isinstance(data, (int, str, dict)) and not isinstance(data, bool):
+            genre = table.get(data.get("name") if isinstance(data, dict) else data)
+            if genre is not None:
+                return genre
+        cache = LookupCache.for_field(self)
         if isinstance(data, int):
-            try:
-                return Genre.objects.get(pk=data)
-            except Genre.DoesNotExist:
+            genre = cache.get(Genre, data)
+            if genre is None:
                 raise serializers.ValidationError("No genre exists with this ID")
+            return genre
         elif isinstance(data, str):
-            try:
-                return Genre.objects.get(name=data)
-            except Genre.DoesNotExist:
+            genre = cache.get(Genre, data)
+            if genre is None:
                 raise serializers.ValidationError("No genre exists with this title")
+            return genre
         elif isinstance(data, dict):
             name = data.get("name")
             if not name:
                 raise serializers.ValidationError("Genre name is required when creating an genre")
 
-            try:
-                return Genre.objects.get(name=name)
-            except Genre.DoesNotExist:
-                serializer = GenreSerializer(data=data)
+            genre = cache.get(Genre, name)
+            if genre is None:
+                serializer = GenreSerializer(data=data, context=self.root.context)
                 serializer.is_valid(raise_exception=True)
-                return serializer.save()
+                genre = serializer.save()
+                cache.add(genre)
+            return genre
         else:
             raise serializers.ValidationError("Genre must be an ID (int), name (str) or object (dict).")
 
 
-class GenreSerializer(serializers.ModelSerializer):
+class GenreSerializer(AtomicSaveMixin, TimedSerializerMixin, SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Genre
         fields = ['name'] # all will also show the ID
@@ -151,7 +204,7 @@ class BookAuthorWriteSerializer(serializers.ModelSerializer):
         fields = ['book', 'role']
 
 
-class AuthorSerializer(serializers.ModelSerializer):
+class AuthorSerializer(AtomicSaveMixin, TimedSerializerMixin, SparseFieldsMixin, serializers.ModelSerializer):
 
     """A serializer to handle authors and also call classes that handle its relationship with books"""
     # could get away without the source for books even when it's not related just because i handle creation myself so DRF does not need the models
@@ -166,7 +219,7 @@ class AuthorSerializer(serializers.ModelSerializer):
 
      # need to override create and update because i have a separate M2M table
     def create(self, validated_data):
-        books_data = validated_data.pop('books', []) # based on the serializer each "book" has a book and an author
+        books_data = validated_data.pop('authored_books', []) # the key is the source of the books field. based on the serializer each "book" has a book and an author
 
 
         # want to do if exists
@@ -175,30 +228,26 @@ class AuthorSerializer(serializers.ModelSerializer):
         author = Author.objects.create(**validated_data) # must pop everything you need before here
         
         # this also handles creating the link when the authors of a nested book being created are missing
-        for item in books_data:
-            BookAuthor.objects.create(
-                book=item['book'],
-                author=author,
-                role=item['role']
-            )
+        sync_book_authors([], [BookAuthor(book=item['book'], author=author, role=item['role']) for item in books_data], key='book_id')
+        author.refresh_from_db(fields=['avg_rating']) # updated in the db by the signals when the links were created
         return author
     
     def update(self, instance, validated_data):
-        books = validated_data.pop('books', None) # None not [] to avoid overwriting when nothing is there
+        books = validated_data.pop('authored_books', None) # None not [] to avoid overwriting when nothing is there
        
         for attr, value in validated_data.items():
             setattr(instance, attr, value)
-            instance.save()
+        if validated_data:
+            instance.save(update_fields=list(validated_data)) # one UPDATE for all the changed fields
 
-        # Delete old relationship objects and recreate them with the new data
+        # Only add/remove/change the links that differ from the new data (already inside the transaction from AtomicSaveMixin)
         if books is not None:
-            BookAuthor.objects.filter(author=instance).delete()
-            for item in books:
-                BookAuthor.objects.create(
-                book=item['book'],
-                author=instance,
-                role=item['role']
-                )
+            sync_book_authors(
+                instance.authored_books.all(),
+                [BookAuthor(book=item['book'], author=instance, role=item['role']) for item in books],
+                key='book_id',
+            )
+            instance.refresh_from_db(fields=['avg_rating'])
         return instance
     
     def get_avg_rating(self, obj):
@@ -216,7 +265,7 @@ class BookMiniSerializer(serializers.ModelSerializer):
         model = Book
         fields = ['title', 'genres', 'rating']
 
-class CopySerializer(serializers.ModelSerializer):
+class CopySerializer(AtomicSaveMixin, TimedSerializerMixin, SparseFieldsMixin, serializers.ModelSerializer):
     """Handles copies and their relationship to books, along with the necessary validation"""
     book = BookLookupField(write_only=True)
     book_info = BookMiniSerializer(source = 'book', read_only=True)
@@ -247,20 +296,20 @@ class CopyMiniSerializer(serializers.ModelSerializer):
         fields = ['lent', 'lent_by', 'return_date']
         read_only_fields = fields
 
-class BookSerializer(serializers.ModelSerializer):
+class BookSerializer(AtomicSaveMixin, TimedSerializerMixin, SparseFieldsMixin, serializers.ModelSerializer):
     """A serializer to handle authors and also call classes that handle its relationship with authors and genres"""
     authors = BookAuthorBookSideWriteSerializer(many=True, write_only=True)
     authors_info = BookAuthorBookSideReadSerializer(source = 'book_authors', many=True, read_only=True) # the source is the related name
     genres = GenreLookupField(many=True, write_only=True)
     genres_info = serializers.StringRelatedField(source='genres', many=True, read_only=True)
     copies = CopyMiniSerializer(many=True, read_only=True)
-    num_copies = serializers.IntegerField(read_only=True) # annotated in view
+    num_copies = serializers.IntegerField(read_only=True) # stored on the book and kept up to date by the signals
     date_published = serializers.DateField() 
     coauthors = serializers.SerializerMethodField(read_only=True) # a method to see if there are multiple authors
 
     class Meta:
         model = Book
-        fields = ['id','title', 'blurb', 'rating', 'genres', 'genres_info', 'authors', 'date_published', 'coauthors' ,'authors_info', 'copies', 'num_copies'] # must incl all firlds -> even WR only
+        fields = ['id','title', 'blurb', 'rating', 'genres', 'genres_info', 'authors', 'date_published', 'coauthors' ,'authors_info', 'copies', 'num_copies', 'num_available', 'num_lent'] # must incl all firlds -> even WR only
  
 
     # !!! using this leades to a bug where if an author is included inside the book either way it's ignored, fixed in validate 
@@ -278,14 +327,9 @@ class BookSerializer(serializers.ModelSerializer):
         # date_published = validated_data.pop('date_published') # have this here instead of a published date per author
 
         book = Book.objects.create(**validated_data) # must pop everything you need before here
-        book.genres.set(genres_data)
+        book.genres.add(*genres_data) # a new book has no genres to diff against, set() would read them first
         
-        for entry in authors_data:
-                BookAuthor.objects.create(
-                    book=book,
-                    author=entry['author'],
-                    role=entry['role'],
-        )
+        sync_book_authors([], [BookAuthor(book=book, author=entry['author'], role=entry['role']) for entry in authors_data], key='author_id')
 
         return book
     
@@ -296,20 +340,18 @@ class BookSerializer(serializers.ModelSerializer):
         
         for attr, value in validated_data.items():
             setattr(instance, attr, value)
-            instance.save()
+        if validated_data:
+            instance.save(update_fields=list(validated_data)) # one UPDATE for all the changed fields
 
         if genres_data is not None:
-            instance.genres.set(genres_data)
+            instance.genres.set(genres_data) # set() already only adds/removes the difference
 
         if authors_data is not None:
-            BookAuthor.objects.filter(book=instance).delete()
-            for entry in authors_data:
-                BookAuthor.objects.create(
-                book=instance,
-                author=entry['author'],
-                role=entry['role'],
+            sync_book_authors(
+                instance.book_authors.all(),
+                [BookAuthor(book=instance, author=entry['author'], role=entry['role']) for entry in authors_data],
+                key='author_id',
             )
-                # date_published = date_published
                 
         return instance
     
@@ -322,7 +364,7 @@ class BookSerializer(serializers.ModelSerializer):
 
     def get_coauthors(self, obj):
         book_authors = obj.book_authors.all()
-        if book_authors.count() > 1:
+        if len(book_authors) > 1: # len instead of count() so a prefetched list does not go back to the db
             return True
         return False
     # could add to representation to change the bame
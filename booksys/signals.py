@@ -0,0 +1,153 @@
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+from .models import *
+from .cache import bump_versions
+from .counters import refresh_author_ratings, refresh_book_counters, refresh_ratings_for_books
+from .stats import mark_book_rollups, mark_books, mark_genres, mark_years
+from .genres import GENRES
+from .changes import record, record_books, record_deleted
+
+"""
+Keeps the denormalized counters and the response cache versions in sync for single object writes (serializers, views, admin, cascades).
+Bulk code paths (update()/bulk_create()) do not send these signals and refresh the counters/bump the versions themselves.
+The same goes for the change feed (changes.py): every saved/deleted object is recorded here, bulk code paths record what they wrote.
+"""
+
+
+def _remember_previous(sender, instance, *fields):
+    # the old values are needed to fix the row the object was moved away from (e.g. a copy moved to another book)
+    if instance.pk is None:
+        instance._previous = {}
+        return
+    instance._previous = sender.objects.filter(pk=instance.pk).values(*fields).first() or {}
+
+
+@receiver(pre_save, sender=Copy)
+def remember_copy_book(sender, instance, **kwargs):
+    _remember_previous(sender, instance, 'book_id')
+
+
+@receiver(post_save, sender=Copy)
+@receiver(post_delete, sender=Copy)
+def update_copy_counters(sender, instance, **kwargs):
+    previous = getattr(instance, '_previous', {})
+    refresh_book_counters([instance.book_id, previous.get('book_id')])
+    mark_books([instance.book_id, previous.get('book_id')])
+    if kwargs['signal'] is post_delete:
+        record_deleted(Copy, [instance.pk])
+    else:
+        record(Copy, [instance.pk])
+
+
+@receiver(pre_save, sender=BookAuthor)
+def remember_book_author(sender, instance, **kwargs):
+    _remember_previous(sender, instance, 'author_id')
+
+
+@receiver(post_save, sender=BookAuthor)
+@receiver(post_delete, sender=BookAuthor)
+def update_author_rating(sender, instance, **kwargs):
+    previous = getattr(instance, '_previous', {})
+    refresh_author_ratings([instance.author_id, previous.get('author_id')])
+    record(Book, [instance.book_id]) # authors_info, the authors are recorded by the refresh
+
+
+@receiver(pre_save, sender=Book)
+def remember_book_rating(sender, instance, **kwargs):
+    _remember_previous(sender, instance, 'title', 'rating', 'date_published')
+
+
+@receiver(post_save, sender=Book)
+def update_ratings_of_book_authors(sender, instance, created, **kwargs):
+    previous = getattr(instance, '_previous', {})
+    if not created and previous.get('rating') != instance.rating: # only when the rating actually changed
+        refresh_ratings_for_books([instance.pk])
+    mark_books([instance.pk])
+    if previous.get('date_published'): # the year it moved away from
+        mark_years([previous['date_published'].year])
+    # copies and authors show the title and rating of the book
+    shown_elsewhere = not created and (previous.get('title'), previous.get('rating')) != (instance.title, instance.rating)
+    record_books([instance.pk], copies=shown_elsewhere, authors=shown_elsewhere)
+
+
+@receiver(pre_delete, sender=Book)
+def mark_deleted_book_rollups(sender, instance, **kwargs):
+    mark_book_rollups([instance.pk])
+
+
+@receiver(pre_save, sender=Author)
+def remember_author_name(sender, instance, **kwargs):
+    _remember_previous(sender, instance, 'name')
+
+
+@receiver(post_save, sender=Author)
+def record_author(sender, instance, created, **kwargs):
+    record(Author, [instance.pk])
+    if not created and getattr(instance, '_previous', {}).get('name') != instance.name: # authors_info of their books
+        record(Book, BookAuthor.objects.filter(author=instance).values_list('book_id', flat=True))
+
+
+@receiver(pre_save, sender=Genre)
+def remember_genre_name(sender, instance, **kwargs):
+    _remember_previous(sender, instance, 'name')
+
+
+@receiver(post_save, sender=Genre)
+def record_genre(sender, instance, created, **kwargs):
+    record(Genre, [instance.pk])
+    if not created and getattr(instance, '_previous', {}).get('name') != instance.name:
+        record_books(instance.books.values_list('pk', flat=True), copies=True)
+
+
+@receiver(pre_delete, sender=Genre)
+def record_books_of_deleted_genre(sender, instance, **kwargs):
+    # the links go with the genre without m2m_changed
+    record_books(instance.books.values_list('pk', flat=True), copies=True)
+
+
+@receiver(post_delete, sender=Book)
+@receiver(post_delete, sender=Author)
+@receiver(post_delete, sender=Genre)
+def record_deleted_object(sender, instance, **kwargs):
+    record_deleted(sender, [instance.pk])
+
+
+def invalidate_cached_responses(sender, **kwargs):
+    bump_versions(sender)
+
+
+# connected per model, a receiver without a sender would turn off Django's fast (single query) deletes for every model
+for model in (Genre, Author, Book, BookAuthor, Copy):
+    post_save.connect(invalidate_cached_responses, sender=model)
+    post_delete.connect(invalidate_cached_responses, sender=model)
+
+
+@receiver(post_save, sender=Genre)
+@receiver(post_delete, sender=Genre)
+def clear_genre_registry(sender, **kwargs):
+    # GenreListView.post, admin, ...: reloaded on the next use in this process, the version bump reaches the others
+    GENRES.clear()
+
+
+@receiver(m2m_changed, sender=Book.genres.through)
+def invalidate_cached_books(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        bump_versions(Book) # the genre rows did not change, the genre list and the registry stay valid
+
+
+@receiver(m2m_changed, sender=Book.genres.through)
+def mark_genre_rollups(sender, instance, action, reverse, pk_set, **kwargs):
+    # forward: instance is a book and pk_set genres, reverse (genre.books.add()): instance is the genre
+    if action in ('post_add', 'post_remove'):
+        mark_genres([instance.pk] if reverse else pk_set)
+    elif action == 'pre_clear': # the genres that are about to be removed
+        mark_genres([instance.pk] if reverse else instance.genres.values_list('pk', flat=True))
+
+
+@receiver(m2m_changed, sender=Book.genres.through)
+def record_genre_links(sender, instance, action, reverse, pk_set, **kwargs):
+    # genres_info of the books and book_info of their copies
+    if action in ('post_add', 'post_remove'):
+        record_books(pk_set if reverse else [instance.pk], copies=True)
+    elif action == 'pre_clear':
+        record_books(instance.books.values_list('pk', flat=True) if reverse else [instance.pk], copies=True)
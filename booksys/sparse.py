@@ -0,0 +1,49 @@
+from rest_framework.exceptions import ValidationError
+
+"""
+Sparse fieldsets for the GET views:
+    ?fields=id,title     only these fields
+    ?exclude=copies      everything but these
+    ?expand=copies       nested relations to add on top of ?fields= (e.g. ?fields=id,title&expand=copies)
+The same object is given to the queryset builders (queries.py) so relations that are not rendered are never prefetched,
+and to the serializer context (SparseFieldsMixin) so they are not rendered.
+"""
+
+
+def _names(request, param):
+    value = request.query_params.get(param)
+    if value is None:
+        return None
+    return {name.strip() for name in value.split(',') if name.strip()}
+
+
+class SparseFields:
+    def __init__(self, fields=None, exclude=None):
+        self.fields = fields # None means every field
+        self.exclude = exclude or set()
+
+    @classmethod
+    def from_request(cls, request, serializer_class):
+        fields = _names(request, 'fields')
+        exclude = _names(request, 'exclude')
+        expand = _names(request, 'expand')
+        if fields is not None and expand:
+            fields |= expand
+
+        readable = {name for name, field in serializer_class().fields.items() if not field.write_only}
+        for param, names in (('fields', fields), ('exclude', exclude), ('expand', expand)):
+            unknown = (names or set()) - readable
+            if unknown:
+                raise ValidationError({param: f"Unknown field(s): {', '.join(sorted(unknown))}."})
+        return cls(fields, exclude)
+
+    def wants(self, name):
+        if name in self.exclude:
+            return False
+        return self.fields is None or name in self.fields
+
+    def wants_any(self, *names):
+        return any(self.wants(name) for name in names)
+
+
+ALL_FIELDS = SparseFields()
@@ -0,0 +1,149 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.db.models.functions import Coalesce, ExtractYear
+from .models import *
+from .cache import bump_versions
+from .routers import PRIMARY, primary
+
+"""
+Catalog statistics (/booksys/stats/) served from the GenreStats/YearStats rollup tables, so a dashboard load reads
+O(genres + years) rows instead of aggregating the whole catalog.
+
+Writes only mark what they touched (mark_books/mark_genres/mark_years, a cheap INSERT into StatsDirty): signals.py for
+single object writes, the bulk code paths themselves. refresh_dirty() then recomputes just those rows, each with one grouped
+query over the books of the dirty genres/years (the copy counts come from the denormalized Book columns, no join to copies).
+It runs before /stats/ answers (BOOKSYS_STATS_REFRESH_ON_READ) or from the refresh_stats command on a schedule. Its reads
+are pinned to the primary (routers.py sends the other reads of a GET to the replica): a lagging replica would have it write
+stale rollups and delete the marks of writes it hasn't seen yet.
+rebuild_stats() recomputes everything.
+"""
+
+ROLLUP_FIELDS = ('num_books', 'rating_sum', 'num_copies', 'num_lent')
+
+
+def _rollups():
+    return {
+        'num_books': Count('pk'),
+        'rating_sum': Coalesce(Sum('rating'), 0.0),
+        'num_copies': Coalesce(Sum('num_copies'), 0),
+        'num_lent': Coalesce(Sum('num_lent'), 0),
+    }
+
+
+def _mark(kind, keys):
+    keys = {key for key in keys if key is not None}
+    if keys:
+        StatsDirty.objects.bulk_create([StatsDirty(kind=kind, key=key) for key in keys], ignore_conflicts=True)
+
+
+def mark_books(book_ids):
+    _mark(StatsDirty.Kind.BOOK, book_ids)
+
+
+def mark_genres(genre_ids):
+    _mark(StatsDirty.Kind.GENRE, genre_ids)
+
+
+def mark_years(years):
+    _mark(StatsDirty.Kind.YEAR, years)
+
+
+def mark_book_rollups(book_ids):
+    """For books that are about to be deleted: their genres/years, since the book key can't be resolved afterwards"""
+    book_ids = list(book_ids)
+    mark_genres(Book.genres.through.objects.filter(book_id__in=book_ids).values_list('genre_id', flat=True))
+    mark_years(Book.objects.filter(pk__in=book_ids).annotate(year=ExtractYear('date_published')).values_list('year', flat=True))
+
+
+def _write(model, key_field, rows, keys):
+    """Replaces the rollup rows of `keys` with the computed `rows` ({key: values}), keys without books get zeros"""
+    existing = set(model.objects.filter(**{f'{key_field}__in': keys}).values_list(key_field, flat=True))
+    updated, created = [], []
+    for key in keys:
+        values = rows.get(key, {'num_books': 0, 'rating_sum': 0.0, 'num_copies': 0, 'num_lent': 0})
+        obj = model(**{key_field: key}, **values)
+        (updated if key in existing else created).append(obj)
+    model.objects.bulk_update(updated, ROLLUP_FIELDS)
+    model.objects.bulk_create(created)
+
+
+def refresh_genres(genre_ids):
+    genre_ids = set(Genre.objects.filter(pk__in=genre_ids).values_list('pk', flat=True)) # deleted genres are gone with their row
+    rows = Book.objects.filter(genres__in=genre_ids).order_by().values('genres').annotate(**_rollups())
+    _write(GenreStats, 'genre_id', {row.pop('genres'): row for row in rows}, genre_ids)
+
+
+def refresh_years(years):
+    years = set(years)
+    rows = (
+        Book.objects.filter(date_published__year__in=years).order_by()
+        .annotate(year=ExtractYear('date_published')).values('year').annotate(**_rollups())
+    )
+    _write(YearStats, 'year', {row.pop('year'): row for row in rows}, years)
+    YearStats.objects.filter(year__in=years, num_books=0).delete() # a year only exists while it has books
+
+
+def refresh_dirty():
+    """Recomputes the rows marked dirty, returns how many marks were processed"""
+    with primary(), transaction.atomic(using=PRIMARY):
+        marks = list(StatsDirty.objects.values_list('pk', 'kind', 'key'))
+        if not marks:
+            return 0
+        genres = {key for _, kind, key in marks if kind == StatsDirty.Kind.GENRE}
+        years = {key for _, kind, key in marks if kind == StatsDirty.Kind.YEAR}
+        books = [key for _, kind, key in marks if kind == StatsDirty.Kind.BOOK]
+        if books:
+            genres |= set(Book.genres.through.objects.filter(book_id__in=books).values_list('genre_id', flat=True))
+            years |= set(Book.objects.filter(pk__in=books).annotate(year=ExtractYear('date_published')).values_list('year', flat=True))
+        if genres:
+            refresh_genres(genres)
+        if years:
+            refresh_years(years)
+        StatsDirty.objects.filter(pk__in=[pk for pk, _, _ in marks]).delete() # marks added meanwhile stay for the next run
+    bump_versions(GenreStats, YearStats) # /stats/ is cached on these too, the book/copy writes were maybe before the last response
+    return len(marks)
+
+
+def rebuild_stats():
+    """Recomputes every rollup row from scratch"""
+    with primary(), transaction.atomic(using=PRIMARY):
+        StatsDirty.objects.all().delete()
+        GenreStats.objects.all().delete()
+        YearStats.objects.all().delete()
+        refresh_genres(Genre.objects.values_list('pk', flat=True))
+        refresh_years(Book.objects.annotate(year=ExtractYear('date_published')).values_list('year', flat=True).distinct())
+    bump_versions(GenreStats, YearStats)
+
+
+def _average(row):
+    return round(row['rating_sum'] / row['num_books'], 2) if row['num_books'] else None
+
+
+def catalog_stats():
+    """The /stats/ payload"""
+    if getattr(settings, 'BOOKSYS_STATS_REFRESH_ON_READ', True):
+        refresh_dirty()
+    genres = list(GenreStats.objects.select_related('genre').order_by('genre__name').values('genre__name', *ROLLUP_FIELDS))
+    years = list(YearStats.objects.order_by('year').values('year', *ROLLUP_FIELDS))
+    # every book has exactly one year, so the year rows add up to the catalog (a book can have several genres)
+    totals = {field: sum(row[field] for row in years) for field in ROLLUP_FIELDS}
+    return {
+        'totals': {
+            'books': totals['num_books'],
+            'avg_rating': _average(totals),
+            'copies': totals['num_copies'],
+            'lent': totals['num_lent'],
+            'available': totals['num_copies'] - totals['num_lent'],
+        },
+        'genres': [
+            {'genre': row['genre__name'], 'books': row['num_books'], 'avg_rating': _average(row),
+             'copies': row['num_copies'], 'lent': row['num_lent'], 'available': row['num_copies'] - row['num_lent']}
+            for row in genres
+        ],
+        'years': [
+            {'year': row['year'], 'books': row['num_books'], 'avg_rating': _average(row),
+             'copies': row['num_copies'], 'lent': row['num_lent']}
+            for row in years
+        ],
+    }
@@ -0,0 +1,69 @@
+import json
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from rest_framework.utils.encoders import JSONEncoder
+
+
+"""
+Streaming responses for full exports. Instead of building serializer.data for the whole table and then rendering it
+into one big string, the queryset is read in chunks (prefetches run per chunk) and every object is serialized and
+written out on its own, so memory stays flat no matter how big the table is.
+"""
+
+STREAM_FORMATS = {
+    '1': 'application/json',
+    'true': 'application/json',
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+def is_stream_requested(request):
+    return request.query_params.get('stream', '').lower() in STREAM_FORMATS
+
+
+def _encode(data):
+    # same compact output as DRF's JSONRenderer
+    return json.dumps(data, cls=JSONEncoder, ensure_ascii=False, separators=(',', ':'))
+
+
+def _iter_objects(queryset, chunk_size):
+    # chunk_size is required for prefetch_related to work with iterator()
+    return queryset.iterator(chunk_size=chunk_size)
+
+
+def _stream_json(queryset, serializer_class, context, chunk_size):
+    yield '['
+    first = True
+    buffer = []
+    for obj in _iter_objects(queryset, chunk_size):
+        item = _encode(serializer_class(obj, context=context).data)
+        buffer.append(item if first else ',' + item)
+        first = False
+        if len(buffer) >= chunk_size: # write once per chunk instead of once per object
+            yield ''.join(buffer)
+            buffer = []
+    buffer.append(']')
+    yield ''.join(buffer)
+
+
+def _stream_ndjson(queryset, serializer_class, context, chunk_size):
+    buffer = []
+    for obj in _iter_objects(queryset, chunk_size):
+        buffer.append(_encode(serializer_class(obj, context=context).data) + '\n')
+        if len(buffer) >= chunk_size:
+            yield ''.join(buffer)
+            buffer = []
+    if buffer:
+        yield ''.join(buffer)
+
+
+def streaming_response(request, queryset, serializer_class, context=None):
+    """?stream=1 (or json) gives a JSON array, ?stream=ndjson gives one object per line"""
+    content_type = STREAM_FORMATS[request.query_params.get('stream').lower()]
+    chunk_size = getattr(settings, 'BOOKSYS_STREAM_CHUNK_SIZE', 2000)
+    if content_type == 'application/x-ndjson':
+        content = _stream_ndjson(queryset, serializer_class, context or {}, chunk_size)
+    else:
+        content = _stream_json(queryset, serializer_class, context or {}, chunk_size)
+    return StreamingHttpResponse(content, content_type=content_type)
@@ -0,0 +1,24 @@
+from django.conf import settings
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+"""
+Test runner (TEST_RUNNER in settings.py). The booksys response cache in settings.py is a directory shared by every process,
+so the dev server, a test run and the --parallel workers of a test run would all read and clear the same entries. Under test
+it is a local memory cache instead: each test process (the parallel workers fork) gets its own, which is all a single process needs.
+"""
+
+
+class TestRunner(DiscoverRunner):
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        alias = getattr(settings, 'BOOKSYS_CACHE_ALIAS', 'booksys')
+        self.test_cache = override_settings(
+            CACHES={**settings.CACHES, alias: {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'booksys-tests'}},
+            SILENCED_SYSTEM_CHECKS=[*settings.SILENCED_SYSTEM_CHECKS, 'booksys.W001'], # one test process is one process
+        )
+        self.test_cache.enable()
+
+    def teardown_test_environment(self, **kwargs):
+        self.test_cache.disable()
+        super().teardown_test_environment(**kwargs)
@@ -1,12 +1,34 @@
 from django.urls import path
 from .views import *
+from .async_views import *
 
 urlpatterns = [
     path('genres/', GenreListView.as_view(), name='genre-list'),
     path('authors/', AuthorListView.as_view(), name='author-list'),
     path('authors/<int:pk>/', AuthorDetailView.as_view(), name='author-detail'),
-    path('books/', BookListView.as_view(), name='author-list'),
+    path('books/', BookListView.as_view(), name='book-list'),
+    path('books/bulk/', BookBulkView.as_view(), name='book-bulk'),
     path('books/<int:pk>/', BookDetailView.as_view(), name='book-detail'),
+    path('books/<int:pk>/checkout/', BookCheckoutView.as_view(), name='book-checkout'),
     path('copies/', CopyListView.as_view(), name='copy-list'),
+    path('copies/bulk/', CopyBulkView.as_view(), name='copy-bulk'),
+    path('copies/checkout/', CopyBatchCheckoutView.as_view(), name='copy-batch-checkout'),
+    path('copies/return/', CopyBatchReturnView.as_view(), name='copy-batch-return'),
+    path('copies/lent/', LentCopiesView.as_view(), name='copy-lent'),
+    path('copies/overdue/', CopyOverdueView.as_view(), name='copy-overdue'),
+    path('copies/due/', CopyDueView.as_view(), name='copy-due'),
     path('copies/<int:pk>/', CopyDetailView.as_view(), name='copy-detail'),
+    path('copies/<int:pk>/checkout/', CopyCheckoutView.as_view(), name='copy-checkout'),
+    path('copies/<int:pk>/return/', CopyReturnView.as_view(), name='copy-return'),
+    path('stats/', StatsView.as_view(), name='stats'),
+    path('changes/', ChangeListView.as_view(), name='change-list'),
+    path('metrics/', MetricsView.as_view(), name='metrics'),
+    # async versions of the GET endpoints for ASGI deployments (async_views.py)
+    path('async/genres/', AsyncGenreListView.as_view(), name='async-genre-list'),
+    path('async/authors/', AsyncAuthorListView.as_view(), name='async-author-list'),
+    path('async/authors/<int:pk>/', AsyncAuthorDetailView.as_view(), name='async-author-detail'),
+    path('async/books/', AsyncBookListView.as_view(), name='async-book-list'),
+    path('async/books/<int:pk>/', AsyncBookDetailView.as_view(), name='async-book-detail'),
+    path('async/copies/', AsyncCopyListView.as_view(), name='async-copy-list'),
+    path('async/copies/<int:pk>/', AsyncCopyDetailView.as_view(), name='async-copy-detail'),
 ]
\ No newline at end of file
@@ -1,19 +1,56 @@
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
+from rest_framework.settings import api_settings
 from .models import *
 from .serializers import *
+from .queries import *
+from .pagination import KeysetPagination
+from .streaming import is_stream_requested, streaming_response
+from .bulk import BulkBookUpsert, BulkCopyCreate, retire_copies
+from .cache import CachedResponseMixin
+from .search import AUTHOR_INDEX, BOOK_INDEX, search_response
+from .sparse import SparseFields
+from .representations import AuthorValues, BookValues, CopyValues, GenreValues, is_enabled as values_path_enabled
+from .renderers import available_renderers, book_table, columnar_response, copy_table, is_columnar_requested
+from .overdue import due_copies, group_copies, lent_copies, overdue_copies, parse_as_of, parse_within
+from .stats import catalog_stats
+from .changes import changes_since, latest_cursor, parse_since
+from .instrumentation import METRICS, is_enabled as instrumentation_enabled
+from .lending import (
+    BatchCheckoutSerializer, BatchReturnSerializer, CheckoutSerializer, LendingConflict,
+    checkout, checkout_any, checkout_batch, return_batch, return_copy,
+)
+from django.conf import settings
 from django.shortcuts import get_object_or_404
 from django.db.models import Avg, Count, Value
 from django.db.models.functions import Coalesce
+from datetime import date
 
 # Create your views here.
 
-class GenreListView(APIView):
+def values_response(request, representation, queryset, paginator):
+    # the list views' paginated/?ordering= answer on the values() path, same output as their serializer branch
+    rows = representation.values(queryset)
+    if paginator.is_requested(request):
+        return paginator.get_paginated_response(representation.data(paginator.paginate_queryset(rows, request)))
+    ordering = paginator.requested_ordering(request)
+    if ordering:
+        rows = rows.order_by(ordering)
+    return Response(representation.data(rows))
+
+
+class GenreListView(CachedResponseMixin, APIView):
+    cache_models = (Genre,)
+    values_path = True # lists are built from values() rows instead of the serializer (representations.py)
     # linked to the url showing all the genres
     def get(self, request):
+        sparse = SparseFields.from_request(request, GenreSerializer)
+        if values_path_enabled(self):
+            representation = GenreValues(sparse)
+            return Response(representation.data(representation.values(Genre.objects.all())))
         genres = Genre.objects.all()
-        serializer = GenreSerializer(genres, many=True)
+        serializer = GenreSerializer(genres, many=True, context={'sparse_fields': sparse})
         return Response(serializer.data)
     
     def post(self, request):
@@ -24,22 +61,31 @@ class GenreListView(APIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
     
 
-class AuthorListView(APIView):
+class AuthorListView(CachedResponseMixin, APIView):
+    cache_models = (Author, BookAuthor, Book)
+    values_path = True
     # linked to the url showing all the authors
     def get(self, request):
-        role = request.query_params.get('role')
-        authors = Author.objects.annotate(
-                avg_rating=Avg('authored_books__book__rating')
-            )
-        
-        if role:
-            authors = authors.filter(authored_books__role__iexact=role).distinct()
+        sparse = SparseFields.from_request(request, AuthorSerializer)
+        context = {'sparse_fields': sparse}
+        authors = filter_authors(author_queryset(sparse), request.query_params)
+
+        if 'q' in request.query_params:
+            return search_response(request, AUTHOR_INDEX, authors, AuthorSerializer, context)
 
-        ordering = request.query_params.get('ordering')
+        paginator = KeysetPagination(ordering_fields=['name'], list_ordering_fields=AUTHOR_LIST_ORDERING_FIELDS) # + the unpaginated list's
+        if values_path_enabled(self):
+            return values_response(request, AuthorValues(sparse), filter_authors(Author.objects.all(), request.query_params), paginator)
+        if paginator.is_requested(request):
+            page = paginator.paginate_queryset(authors, request)
+            serializer = AuthorSerializer(page, many=True, context=context)
+            return paginator.get_paginated_response(serializer.data)
+
+        ordering = paginator.requested_ordering(request)
         if ordering:
             authors = authors.order_by(ordering)
         
-        serializer = AuthorSerializer(authors, many=True)
+        serializer = AuthorSerializer(authors, many=True, context=context)
         return Response(serializer.data)
     
     def post(self, request):
@@ -54,14 +100,14 @@ class AuthorListView(APIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
-class AuthorDetailView(APIView):
+class AuthorDetailView(CachedResponseMixin, APIView):
+    cache_models = (Author, BookAuthor, Book)
     # linked to the url showing a specific author
     def get(self, request, pk):
-        queryset = Author.objects.annotate(
-                avg_rating=Avg('authored_books__book__rating')
-            )
+        sparse = SparseFields.from_request(request, AuthorSerializer)
+        queryset = author_queryset(sparse)
         author = get_object_or_404(queryset, pk=pk) #pass query set instead of the model
-        serializer = AuthorSerializer(author)
+        serializer = AuthorSerializer(author, context={'sparse_fields': sparse})
         return Response(serializer.data)
     
     def put(self, request, pk):
@@ -99,28 +145,40 @@ class AuthorDetailView(APIView):
     
 
 
-class BookListView(APIView):
+class BookListView(CachedResponseMixin, APIView):
+    cache_models = (Book, BookAuthor, Author, Genre, Copy)
+    values_path = True
+    renderer_classes = api_settings.DEFAULT_RENDERER_CLASSES + available_renderers() # + msgpack/arrow (renderers.py)
     # linked to the url showing all books
     def get(self, request):
+        paginator = KeysetPagination(ordering_fields=BOOK_ORDERING_FIELDS) # also the ?ordering= allowlist of every other branch
+        if is_columnar_requested(request):
+            books = filter_books(Book.objects.all(), request.query_params)
+            return columnar_response(request, books, book_table, paginator.requested_ordering(request))
 
-        # getting query parameters
-        genre = request.query_params.get('genres')
-        author_name = request.query_params.get('book_authors')
+        sparse = SparseFields.from_request(request, BookSerializer)
+        context = {'sparse_fields': sparse}
+        books = filter_books(book_queryset(sparse), request.query_params) # ?genres=, ?rating__gte=, ... (queries.py)
 
-        books = Book.objects.annotate(
-            num_copies=Coalesce(Count('copies'), Value(0))
-        )
+        if 'q' in request.query_params:
+            return search_response(request, BOOK_INDEX, books, BookSerializer, context)
+
+        if is_stream_requested(request):
+            ordering = paginator.requested_ordering(request)
+            return streaming_response(request, books.order_by(ordering or 'id'), BookSerializer, context)
 
-        if genre:
-            books = books.filter(genres__name__iexact=genre).distinct()
-        if author_name:
-            books = books.filter(book_authors__author__name__iexact=author_name)
+        if values_path_enabled(self):
+            return values_response(request, BookValues(sparse), filter_books(Book.objects.all(), request.query_params), paginator)
+        if paginator.is_requested(request):
+            page = paginator.paginate_queryset(books, request)
+            serializer = BookSerializer(page, many=True, context=context)
+            return paginator.get_paginated_response(serializer.data)
 
-        ordering = request.query_params.get('ordering')
+        ordering = paginator.requested_ordering(request)
         if ordering:
             books = books.order_by(ordering)
 
-        serializer = BookSerializer(books, many=True)
+        serializer = BookSerializer(books, many=True, context=context)
         return Response(serializer.data)
     
     def post(self, request):
@@ -131,15 +189,26 @@ class BookListView(APIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
     
 
-class BookDetailView(APIView):
+class BookBulkView(APIView):
+    # linked to the url for importing/upserting many books in one request
+    def post(self, request):
+        if not isinstance(request.data, list):
+            return Response({"detail": "Expected a list of books."}, status=status.HTTP_400_BAD_REQUEST)
+        result = BulkBookUpsert(request.data).run()
+        if result['errors'] and not (result['created'] or result['updated']):
+            return Response(result, status=status.HTTP_400_BAD_REQUEST)
+        return Response(result)
+
+
+class BookDetailView(CachedResponseMixin, APIView):
+    cache_models = (Book, BookAuthor, Author, Genre, Copy)
 
     # linked to the url showing a specific book
     def get(self, request, pk):
-        queryset = Book.objects.annotate(
-                num_copies= Coalesce(Count('copies'), Value(0))
-            )
+        sparse = SparseFields.from_request(request, BookSerializer)
+        queryset = book_queryset(sparse)
         book = get_object_or_404(queryset, pk=pk) #pass query set instead of the model
-        serializer = BookSerializer(book)
+        serializer = BookSerializer(book, context={'sparse_fields': sparse})
         return Response(serializer.data)
     
     def put(self, request, pk):
@@ -164,32 +233,37 @@ class BookDetailView(APIView):
         return Response(status=204)
 
 
-class CopyListView(APIView):
+class CopyListView(CachedResponseMixin, APIView):
+    cache_models = (Copy, Book, Genre)
+    values_path = True
+    renderer_classes = api_settings.DEFAULT_RENDERER_CLASSES + available_renderers()
     # linked to the url showing all copies
     def get(self, request):
-        copies = Copy.objects.all()
-        book = request.query_params.get('book')
-        genre = request.query_params.get('genre')
-        lent = request.query_params.get('lent')
+        paginator = KeysetPagination(ordering_fields=['lent']) # also the ?ordering= allowlist of every other branch
+        if is_columnar_requested(request):
+            copies = filter_copies(Copy.objects.all(), request.query_params)
+            return columnar_response(request, copies, copy_table, paginator.requested_ordering(request))
 
-        if book:
-            copies = copies.filter(book__title__iexact=book).distinct()
+        sparse = SparseFields.from_request(request, CopySerializer)
+        context = {'sparse_fields': sparse}
+        copies = filter_copies(copy_queryset(sparse), request.query_params) # ?book=, ?genre= and ?lent=
 
-        if genre:
-            copies = copies.filter(book__genres__name__iexact=genre).distinct()
+        if is_stream_requested(request):
+            ordering = paginator.requested_ordering(request)
+            return streaming_response(request, copies.order_by(ordering or 'id'), CopySerializer, context)
 
-        if lent:
-            if lent.lower() == 'true':
-                copies = copies.filter(lent=True)
-            elif lent.lower() == 'false':
-                copies = copies.filter(lent=False)
+        if values_path_enabled(self):
+            return values_response(request, CopyValues(sparse), filter_copies(Copy.objects.all(), request.query_params), paginator)
+        if paginator.is_requested(request):
+            page = paginator.paginate_queryset(copies, request)
+            serializer = CopySerializer(page, many=True, context=context)
+            return paginator.get_paginated_response(serializer.data)
 
-        ordering = request.query_params.get('ordering')
+        ordering = paginator.requested_ordering(request)
         if ordering:
-            books = books.order_by(ordering)
-
+            copies = copies.order_by(ordering)
 
-        serializer = CopySerializer(copies, many=True)
+        serializer = CopySerializer(copies, many=True, context=context)
         return Response(serializer.data)
     
     def post(self, request):
@@ -200,12 +274,96 @@ class CopyListView(APIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
     
 
-class CopyDetailView(APIView):
+class CopyBulkView(APIView):
+    # linked to the url for provisioning/retiring many copies in one request
+    def post(self, request):
+        # {"book": ..., "count": n} for n copies of one book, or a list of such copy specs
+        items = [request.data] if isinstance(request.data, dict) else request.data
+        if not isinstance(items, list):
+            return Response({"detail": "Expected a copy spec or a list of them."}, status=status.HTTP_400_BAD_REQUEST)
+        result = BulkCopyCreate(items).run()
+        if result['errors'] and not result['created']:
+            return Response(result, status=status.HTTP_400_BAD_REQUEST)
+        return Response(result, status=status.HTTP_201_CREATED)
+
+    def delete(self, request):
+        # the same ?book=, ?genre= and ?lent= filters as the copy list, at least one so a bare DELETE can't empty the table
+        params = request.query_params
+        if not {'book', 'genre', 'lent'} & set(params):
+            return Response({"detail": "Give at least one of the book, genre or lent filters."}, status=status.HTTP_400_BAD_REQUEST)
+        # filter_copies ignores the values it does not understand, here that would mean deleting every copy
+        errors = {name: "This filter can't be empty." for name in ('book', 'genre') if name in params and not params[name]}
+        if 'lent' in params and params['lent'].lower() not in ('true', 'false'):
+            errors['lent'] = "Must be true or false."
+        if errors:
+            return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+        copies = filter_copies(Copy.objects.all(), params)
+        if not copies.query.where: # last line of defence, never an unfiltered DELETE
+            return Response({"detail": "Give at least one of the book, genre or lent filters."}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({'deleted': retire_copies(copies)})
+
+
+class LentCopiesView(CachedResponseMixin, APIView):
+    """
+    Every lent copy (copies/lent/) and the base of the overdue/due soon lists: ?as_of= (default today), ?group_by=lent_by|book,
+    ?ordering=return_date|id, paginated/streamed like the copy list
+    """
+    cache_models = (Copy, Book, Genre)
+    values_path = True
+
+    def get_cache_vary(self, request):
+        return [date.today().isoformat()] # the same url means other copies tomorrow
+
+    def get_copies(self, request, as_of, queryset=None):
+        # the subclasses narrow it down to a range of return dates
+        return lent_copies(queryset)
+
+    def get(self, request):
+        as_of = parse_as_of(request.query_params.get('as_of'))
+        group_by = request.query_params.get('group_by')
+        if group_by:
+            return Response(group_copies(self.get_copies(request, as_of), group_by))
+
+        sparse = SparseFields.from_request(request, CopySerializer)
+        context = {'sparse_fields': sparse}
+        copies = self.get_copies(request, as_of, copy_queryset(sparse))
+        paginator = KeysetPagination(ordering_fields=['return_date'], default_ordering='return_date')
+        ordering = paginator.get_ordering(request) # the ?ordering= allowlist of every branch, return_date when there is none
+        if is_stream_requested(request):
+            return streaming_response(request, copies.order_by(ordering, 'id'), CopySerializer, context)
+
+        if values_path_enabled(self):
+            representation = CopyValues(sparse)
+            rows = representation.values(self.get_copies(request, as_of, Copy.objects.all()))
+            if paginator.is_requested(request):
+                return paginator.get_paginated_response(representation.data(paginator.paginate_queryset(rows, request)))
+            return Response(representation.data(rows.order_by(ordering, 'id')))
+        if paginator.is_requested(request):
+            page = paginator.paginate_queryset(copies, request)
+            return paginator.get_paginated_response(CopySerializer(page, many=True, context=context).data)
+        return Response(CopySerializer(copies.order_by(ordering, 'id'), many=True, context=context).data)
+
+
+class CopyOverdueView(LentCopiesView):
+    # lent copies whose return date has passed
+    def get_copies(self, request, as_of, queryset=None):
+        return overdue_copies(as_of, queryset)
+
+
+class CopyDueView(LentCopiesView):
+    # lent copies due back in the next ?within= days (default 7d)
+    def get_copies(self, request, as_of, queryset=None):
+        return due_copies(as_of, parse_within(request.query_params.get('within', '7d')), queryset)
+
+
+class CopyDetailView(CachedResponseMixin, APIView):
+    cache_models = (Copy, Book, Genre)
 
     # linked to the url showing a specific copy
     def get(self, request, pk):
-        copy = get_object_or_404(Copy, pk=pk) #pass query set instead of the model
-        serializer = CopySerializer(copy)
+        sparse = SparseFields.from_request(request, CopySerializer)
+        copy = get_object_or_404(copy_queryset(sparse), pk=pk) #pass query set instead of the model
+        serializer = CopySerializer(copy, context={'sparse_fields': sparse})
         return Response(serializer.data)
     
     def put(self, request, pk):
@@ -228,4 +386,97 @@ class CopyDetailView(APIView):
         copy = get_object_or_404(Copy, pk=pk)
         copy.delete()
         return Response(status=204)
-        
\ No newline at end of file
+        
+
+class CopyCheckoutView(APIView):
+    # claims the copy with one conditional update, lending a copy that is already lent is a 409
+    def post(self, request, pk):
+        serializer = CheckoutSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=400)
+        try:
+            checkout(pk, **serializer.validated_data)
+        except Copy.DoesNotExist:
+            return Response({'detail': "Not found."}, status=404)
+        except LendingConflict as conflict:
+            return Response({'detail': str(conflict)}, status=409)
+        return Response(CopySerializer(get_object_or_404(copy_queryset(), pk=pk)).data)
+
+
+class CopyReturnView(APIView):
+    def post(self, request, pk):
+        try:
+            return_copy(pk)
+        except Copy.DoesNotExist:
+            return Response({'detail': "Not found."}, status=404)
+        except LendingConflict as conflict:
+            return Response({'detail': str(conflict)}, status=409)
+        return Response(CopySerializer(get_object_or_404(copy_queryset(), pk=pk)).data)
+
+
+class CopyBatchCheckoutView(APIView):
+    # lends many copies at once, the ones that are lent already or do not exist are listed in `errors` with their id
+    def post(self, request):
+        serializer = BatchCheckoutSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=400)
+        return batch_response(checkout_batch(serializer.validated_data['entries']))
+
+
+class CopyBatchReturnView(APIView):
+    # returns many copies at once (e.g. a scanned batch of barcodes)
+    def post(self, request):
+        serializer = BatchReturnSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=400)
+        return batch_response(return_batch(serializer.validated_data['ids']))
+
+
+def batch_response(result):
+    # a conflict when none of the copies could be lent/returned
+    return Response(result, status=409 if result['errors'] and not result['applied'] else 200)
+
+
+class BookCheckoutView(APIView):
+    # lends any available copy of the book
+    def post(self, request, pk):
+        get_object_or_404(Book.objects.only('pk'), pk=pk)
+        serializer = CheckoutSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=400)
+        try:
+            copy_id = checkout_any(pk, **serializer.validated_data)
+        except LendingConflict as conflict:
+            return Response({'detail': str(conflict)}, status=409)
+        copy = CopySerializer(get_object_or_404(copy_queryset(), pk=copy_id)).data
+        return Response({'id': copy_id, **copy}) # the copy serializer has no id, the caller needs to know which copy it got
+
+
+class MetricsView(APIView):
+    """p50/p95/p99 per endpoint from the instrumentation middleware, only answered to local/INTERNAL_IPS clients"""
+    def get(self, request):
+        local = {'127.0.0.1', '::1', *getattr(settings, 'INTERNAL_IPS', [])}
+        if not instrumentation_enabled() or request.META.get('REMOTE_ADDR') not in local:
+            return Response({'detail': "Not found."}, status=404)
+        return Response(METRICS.snapshot())
+
+
+class StatsView(CachedResponseMixin, APIView):
+    cache_models = (Book, Copy, Genre, GenreStats, YearStats) # the rollups are also rewritten by refresh_stats
+
+    # counts and average ratings per genre and per year, and copies lent vs available, from the rollup tables (stats.py)
+    def get(self, request):
+        return Response(catalog_stats())
+
+
+class ChangeListView(APIView):
+    """
+    The change feed (changes.py). Without ?since= only the current cursor: take it, download the lists, then keep calling
+    ?since=<cursor> (with the cursor of the last page) and apply the changes. Never cached, the cursor is the version.
+    """
+    def get(self, request):
+        if 'since' not in request.query_params:
+            return Response({'changes': [], 'cursor': latest_cursor(), 'has_more': False})
+        since = parse_since(request.query_params['since'])
+        limit = KeysetPagination(ordering_fields=[]).get_page_size(request)
+        return Response(changes_since(since, limit))
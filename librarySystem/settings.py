@@ -41,6 +41,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'booksys.middleware.InstrumentationMiddleware', # first so it times everything, removes itself when BOOKSYS_INSTRUMENTATION is off
+    'booksys.middleware.ReadRoutingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -78,9 +80,32 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
-    }
+        'CONN_MAX_AGE': 60, # keep connections open between requests instead of reconnecting every time
+        'CONN_HEALTH_CHECKS': True, # but check a reused connection still works first
+        'OPTIONS': {
+            # take the write lock at BEGIN: a deferred transaction that reads and then writes fails right away with
+            # "database is locked" when another writer got in between, whatever the busy timeout is
+            'transaction_mode': 'IMMEDIATE',
+        },
+    },
+    # booksys GET requests read from this alias when it exists (booksys/routers.py), e.g. a Postgres streaming replica:
+    # 'replica': {
+    #     'ENGINE': 'django.db.backends.postgresql',
+    #     'HOST': 'replica.internal',
+    #     ...
+    #     'CONN_MAX_AGE': 60,
+    #     'CONN_HEALTH_CHECKS': True,
+    #     'TEST': {'MIRROR': 'default'},
+    # },
 }
 
+DATABASE_ROUTERS = ['booksys.routers.ReadReplicaRouter']
+BOOKSYS_READ_DATABASE = 'replica'
+
+# PRAGMAs run on every new SQLite connection (booksys/db.py has the defaults, BOOKSYS_SQLITE_PRAGMAS = {...} replaces them)
+# WAL is stored in the database file, turn it on for a deployment's own database, not for the db.sqlite3 in the repo
+BOOKSYS_SQLITE_WAL = False
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -122,3 +147,56 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.1/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # response cache and version counters of the booksys GET views (see booksys/cache.py)
+    # it has to be shared by every worker process, a write in one of them must invalidate the responses cached by the others
+    # (a local memory cache only works with a single process, check booksys.W001 warns about it), redis/memcached work too
+    # the tests run with their own local memory cache instead (booksys/testing.py), clear this one when you swap db.sqlite3
+    'booksys': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'cache',
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+}
+
+BOOKSYS_CACHE_ALIAS = 'booksys'
+TEST_RUNNER = 'booksys.testing.TestRunner'
+BOOKSYS_RESPONSE_CACHE = True
+BOOKSYS_CACHE_TIMEOUT = 300 # seconds a cached response is kept, writes make it unreachable earlier anyway
+
+
+# booksys keyset pagination (used when a list is requested with ?cursor= or ?page_size=)
+BOOKSYS_PAGE_SIZE = 50
+BOOKSYS_MAX_PAGE_SIZE = 500
+
+# rows read per chunk when streaming an export (?stream=1 / ?stream=ndjson)
+BOOKSYS_STREAM_CHUNK_SIZE = 2000
+
+# rows per INSERT/UPDATE in the bulk endpoints
+BOOKSYS_BULK_BATCH_SIZE = 1000
+# largest `count` of one item of POST /booksys/copies/bulk/
+BOOKSYS_BULK_MAX_COPIES = 10000
+
+# checkout/return: retries of a write that hit "database is locked", the delay doubles every retry
+BOOKSYS_LOCK_RETRIES = 5
+BOOKSYS_LOCK_RETRY_DELAY = 0.05 # seconds
+
+# per request query/latency numbers of the booksys views (booksys/instrumentation.py), p50/p95/p99 at /booksys/metrics/
+BOOKSYS_INSTRUMENTATION = False
+BOOKSYS_INSTRUMENTATION_HEADER = False # X-Booksys-Stats response header
+BOOKSYS_INSTRUMENTATION_LOG = False # a line per request on the booksys.instrumentation logger, with the slowest statement
+BOOKSYS_METRICS_SAMPLES = 1000 # requests kept per endpoint for the percentiles
+
+# recompute the changed /booksys/stats/ rollups when the endpoint is read, turn off when `refresh_stats` runs on a schedule
+BOOKSYS_STATS_REFRESH_ON_READ = True
+
+# the list views build their JSON from values() rows instead of the serializers (representations.py), False to go back to the serializers
+BOOKSYS_VALUES_PATH = True